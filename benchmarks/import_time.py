@@ -0,0 +1,27 @@
+"""
+Check that `import wobble` and reading a Results file stay cheap:
+neither may load TensorFlow, and the import must finish within its time budget.
+Usage: python benchmarks/import_time.py [results file]
+"""
+import sys
+import subprocess
+
+IMPORT_BUDGET = 0.5 # seconds, cold `import wobble`
+
+def run(code):
+    out = subprocess.check_output([sys.executable, '-c', code])
+    return out.decode().split()
+
+if __name__ == "__main__":
+    failed = False
+    checks = [('import', "import wobble", IMPORT_BUDGET)]
+    if len(sys.argv) > 1:
+        checks.append(('Results.read', "import wobble; wobble.Results(filename={0!r})".format(sys.argv[1]), None))
+    for label, code, budget in checks:
+        dt, tf_loaded = run("from time import time; t0 = time(); {0}; t1 = time(); import sys; "
+                            "print(t1 - t0, 'tensorflow' in sys.modules)".format(code))[-2:]
+        ok = (budget is None or float(dt) < budget) and tf_loaded == 'False'
+        failed = failed or not ok
+        print("{0}: {1:.3f} s, tensorflow loaded: {2} [{3}]".format(label, float(dt), tf_loaded, 
+                                                                   'ok' if ok else 'FAIL'))
+    sys.exit(int(failed))
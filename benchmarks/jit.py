@@ -0,0 +1,32 @@
+"""
+Compare the cost per optimization step of optimize_order() with and without
+XLA compilation of the training step.
+Usage: python benchmarks/jit.py <data file> [order] [niter]
+The per-step cost is measured as the difference in runtime between a long and 
+a short run, which takes out the template initialization and graph building.
+Note that the compiled step applies all updates at once, from gradients taken 
+before any of them (see group_updates()), while the uncompiled one applies 
+them one after the other, so the two runs take slightly different paths.
+"""
+import sys
+from time import time
+import wobble
+
+def time_order(filename, order, niter, compile):
+    data = wobble.Data(filename, filepath='', orders=[order])
+    model = wobble.Model(data)
+    model.add_star('star')
+    model.add_telluric('tellurics', variable_bases=3)
+    start = time()
+    wobble.optimize_order(model, data, 0, niter=niter, compile=compile)
+    return time() - start
+
+if __name__ == "__main__":
+    filename = sys.argv[1]
+    order = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    niter = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    for compile in [False, True]:
+        t_short = time_order(filename, order, 1, compile)
+        t_long = time_order(filename, order, niter + 1, compile)
+        print("compile={0}: {1:.2f} ms per step ({2:.2f} s setup)".format(compile, 
+                1.e3 * (t_long - t_short) / niter, t_short))
@@ -0,0 +1,105 @@
+"""
+Benchmark suite: time the main stages of a wobble run on synthetic data
+as each of N (epochs), R (orders), M (pixels) and K (telluric basis vectors)
+is scaled up from a small baseline.
+Usage: python benchmarks/suite.py [output.jsonl] [--quick]
+Each measurement is appended to the output file as one JSON line, e.g.
+{"benchmark": "optimize_order_step", "N": 32, "R": 1, "M": 1024, "K": 0, "seconds": 0.012, ...}
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import platform
+import subprocess
+from time import time
+import wobble
+from wobble.make_data_synthetic import make_data
+
+BASELINE = {'N': 16, 'R': 1, 'M': 1024, 'K': 0}
+SCALINGS = {'N': [16, 64, 256], 'R': [1, 4, 16], 'M': [1024, 2048, 4096], 'K': [0, 1, 3]}
+NITER = (5, 25) # the per-step cost is the runtime difference of these two run lengths
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+def build_model(data, K):
+    model = wobble.Model(data)
+    model.add_star('star')
+    model.add_telluric('tellurics', variable_bases=K)
+    return model
+
+def run_config(filename, config, tmpdir):
+    """
+    Time each stage for one configuration; returns a dictionary of timings in seconds.
+    """
+    times = {}
+    orders = list(range(config['R']))
+    start = time()
+    data = wobble.Data(os.path.basename(filename), filepath=os.path.dirname(filename)+'/', orders=orders)
+    times['data_load'] = time() - start
+
+    model = build_model(data, config['K'])
+    start = time()
+    for r in range(data.R):
+        for c in model.components:
+            c.initialize_template(r, data, other_components=[x for x in model.components if x!=c])
+    times['initialize_template'] = (time() - start) / data.R
+
+    step_times = []
+    for niter in NITER:
+        model = build_model(data, config['K'])
+        start = time()
+        results = wobble.optimize_order(model, data, 0, niter=niter)
+        step_times.append(time() - start)
+    times['optimize_order_step'] = (step_times[1] - step_times[0]) / (NITER[1] - NITER[0])
+    times['optimize_order_setup'] = step_times[0] - NITER[0] * times['optimize_order_step']
+
+    start = time()
+    model.components[0].combine_orders()
+    times['combine_orders'] = time() - start
+
+    results_file = os.path.join(tmpdir, 'results.hdf5')
+    start = time()
+    results = wobble.Results(model=model, data=data)
+    times['results_copy'] = time() - start
+    start = time()
+    results.write(results_file)
+    times['results_write'] = time() - start
+    start = time()
+    wobble.Results(filename=results_file)
+    times['results_read'] = time() - start
+    return times
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    output = args[0] if len(args) > 0 else 'benchmarks.jsonl'
+    scalings = SCALINGS
+    if '--quick' in sys.argv:
+        scalings = {k: v[:2] for k,v in SCALINGS.items()}
+    meta = {'revision': git_revision(), 'python': platform.python_version(),
+            'machine': platform.machine(), 'timestamp': time()}
+    tmpdir = tempfile.mkdtemp()
+    done = []
+    try:
+        with open(output, 'a') as f:
+            for dim, values in scalings.items():
+                for value in values:
+                    config = dict(BASELINE)
+                    config[dim] = value
+                    if config in done: # the baseline shows up in every scaling
+                        continue
+                    done.append(config)
+                    filename = os.path.join(tmpdir, 'synthetic.hdf5')
+                    make_data(filename, **config)
+                    for benchmark, seconds in run_config(filename, config, tmpdir).items():
+                        record = dict(meta, benchmark=benchmark, seconds=seconds, **config)
+                        f.write(json.dumps(record) + '\n')
+                        print("{0:>22s} N={N:<5d} R={R:<3d} M={M:<5d} K={K:<2d} {1:.4f} s".format(benchmark, seconds, **config))
+    finally:
+        shutil.rmtree(tmpdir)
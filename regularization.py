@@ -1,6 +1,5 @@
 import numpy as np
 import matplotlib.pyplot as plt
-import copy
 import wobble
 import tensorflow as tf
 from tqdm import tqdm
@@ -60,12 +59,10 @@ class Parameters(object):
              
 def fit_rvs_only(model, data, r, niter=80):
     synth = model.synthesize(r)
-    nll = 0.5*tf.reduce_sum(tf.square(tf.boolean_mask(data.ys[r], data.epoch_mask) 
-                                      - tf.boolean_mask(synth, data.epoch_mask)) 
-                            * tf.boolean_mask(data.ivars[r], data.epoch_mask)) 
+    nll = data.nll(r, synth)
     for c in model.components:
         if c.K > 0:
-            nll += c.L2_basis_weights[r] * tf.reduce_sum(tf.square(c.basis_weights[r]))
+            nll += c.L2_basis_weights[r] * tf.reduce_sum(tf.cast(tf.square(c.basis_weights[r]), tf.float64))
     
     # set up optimizers: 
     session = wobble.get_session()
@@ -104,11 +101,8 @@ def improve_order_regularization(model, data, r, verbose=True, plot=False, basen
     validation_epochs = np.random.choice(data.N, data.N//10, replace=False)
     training_epochs = np.delete(np.arange(data.N), validation_epochs)
     
-    training_data = copy.copy(data)
-    training_data.epoch_mask = np.isin(np.arange(data.N), training_epochs)
-    validation_mask = np.isin(np.arange(data.N), validation_epochs)
-    validation_data = copy.copy(data)
-    validation_data.epoch_mask = validation_mask 
+    training_data = data.subset(epochs=training_epochs)
+    validation_data = data.subset(epochs=validation_epochs)
     
     if L2:
         for c in model.components:
@@ -257,11 +251,12 @@ if __name__ == "__main__":
 
     
     start_time = time()
+    all_data = wobble.Data(starname+'_e2ds.hdf5', filepath='data/', orders=list(range(R)))
     
     for r in range(R):
         print("starting order {0}...".format(r))
-        # make new data and model objects - this avoids wasting time with a giant results file
-        data = wobble.Data(starname+'_e2ds.hdf5', filepath='data/', orders=[r])
+        # single-order views of the data and new model objects - this avoids wasting time with a giant results file
+        data = all_data.subset(orders=[r])
         model = wobble.Model(data)
         model.add_star('star')
         model.add_telluric('tellurics', rvs_fixed=True, variable_bases=K)
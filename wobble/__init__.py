@@ -1,4 +1,23 @@
 name = "wobble"
-from .wobble import *
 from .utils import *
-from .interp import interp
\ No newline at end of file
+from .results import Results
+from .metrics import Metrics
+from .library import TemplateLibrary
+
+# Everything else needs TensorFlow, so it is only imported on first use
+# (e.g. wobble.Data), which keeps `import wobble` and reading Results light.
+_LAZY = ["get_session", "Context", "doppler", "Data", "Model", "History", "optimize_order", "optimize_orders", 
+         "optimize_order_chunked", "optimize_order_minibatch", "optimize_order_multires", "optimize_rvs_order", 
+         "infer_rvs", "optimize_orders_coadded", "compare_precision", 
+         "compare_chunk_modes", "compare_multires", "interp"]
+
+__all__ = utils.__all__ + ["Results", "Metrics", "TemplateLibrary"] + _LAZY
+
+def __getattr__(attr):
+    if attr not in _LAZY:
+        raise AttributeError("module 'wobble' has no attribute '{0}'".format(attr))
+    from . import wobble as core
+    from .interp import interp # importing the submodule binds wobble.interp to it; undo that
+    globals().update({a: getattr(core, a) for a in _LAZY if a != "interp"})
+    globals()["interp"] = interp
+    return globals()[attr]
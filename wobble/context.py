@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import division, print_function
+
+__all__ = ["Context", "scope", "in_context"]
+
+import functools
+import threading
+import tensorflow as tf
+
+
+class Context(object):
+    """
+    An isolated place to run a model in: its own graph and session, with its
+    own thread pools and (optionally) device placement. Pass it to Data()
+    (Models and Results take it from their data) and everything built for
+    that data lives in the context, so that several models can run side by
+    side in one process, e.g. one per thread, without sharing a graph or
+    competing for the same threads. close() frees the session and its memory.
+
+    Inside a with-block the context is the default graph, session and device,
+    so that get_session() and all new ops use it.
+
+    Args:
+        `intra_op_threads`: threads used within each op (0 = TensorFlow picks)
+        `inter_op_threads`: ops run in parallel (0 = TensorFlow picks)
+        `device`: device to place the ops on, e.g. '/cpu:0' (optional)
+        `config`: tf.ConfigProto to start from (optional)
+    """
+    def __init__(self, intra_op_threads=0, inter_op_threads=0, device=None, config=None):
+        if config is None:
+            config = tf.ConfigProto(allow_soft_placement=True)
+        config.intra_op_parallelism_threads = intra_op_threads
+        config.inter_op_parallelism_threads = inter_op_threads
+        if intra_op_threads or inter_op_threads:
+            config.use_per_session_threads = True # not the process-wide pool
+        self.device = device
+        self.graph = tf.Graph()
+        self.session = tf.Session(graph=self.graph, config=config)
+        self.local = threading.local() # open scopes of each thread
+
+    def __enter__(self):
+        if self.session is None:
+            raise RuntimeError("Context: used after close()")
+        scopes = [self.graph.as_default(), self.session.as_default()]
+        if self.device is not None:
+            scopes.append(self.graph.device(self.device))
+        for s in scopes:
+            s.__enter__()
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        self.local.stack.append(scopes)
+        return self
+
+    def __exit__(self, *args):
+        for s in reversed(self.local.stack.pop()):
+            s.__exit__(*args)
+
+    def run(self, *args, **kwargs):
+        return self.session.run(*args, **kwargs)
+
+    def close(self):
+        """
+        Close the session, which frees the data and variables held in it.
+        Data, Models and Results built in this context can no longer be used.
+        """
+        if self.session is not None:
+            self.session.close()
+        self.session = None
+        self.graph = None
+
+
+class NullScope(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *args):
+        pass
+
+def scope(context):
+    """
+    with-block scope of context; does nothing if it is None (the global session).
+    """
+    if context is None:
+        return NullScope()
+    return context
+
+def in_context(func):
+    """
+    Decorator: run func in the context of its first argument (a Data or Model, 
+    or the object of a method), if it has one.
+    """
+    @functools.wraps(func)
+    def wrapper(obj, *args, **kwargs):
+        with scope(getattr(obj, 'context', None)):
+            return func(obj, *args, **kwargs)
+    return wrapper
@@ -2,17 +2,44 @@
 
 from __future__ import division, print_function
 
-__all__ = ["interp", "searchsorted"]
+__all__ = ["interp", "interp_with_slope", "searchsorted", "searchsorted_uniform"]
 
 import tensorflow as tf
 from ..tf_utils import load_op_library
 
-mod = load_op_library(__file__, "interp_op")
-searchsorted = mod.searchsorted
+mod = None
 
 
-def interp(t, x, y):
-    inds = searchsorted(x, t)
+def searchsorted(a, v):
+    """The custom searchsorted op; the library is loaded on first use"""
+    global mod
+    if mod is None:
+        mod = load_op_library(__file__, "interp_op")
+    return mod.searchsorted(a, v)
+
+
+def searchsorted_uniform(x, t):
+    """Same as searchsorted, but for a uniformly spaced grid x
+
+    Built from standard ops only, so that it can be compiled with XLA.
+
+    """
+    dx = x[1] - x[0]
+    inds = tf.ceil((t - x[0]) / dx)
+    inds = tf.clip_by_value(inds, 0., tf.cast(tf.shape(x)[0], t.dtype))
+    return tf.cast(inds, tf.int64)
+
+
+def interp(t, x, y, uniform=False):
+    return interp_with_slope(t, x, y, uniform=uniform)[0]
+
+
+def interp_with_slope(t, x, y, uniform=False):
+    """Linear interpolation that also returns the derivative dy/dt at t"""
+    if uniform:
+        inds = searchsorted_uniform(x, t)
+    else:
+        inds = searchsorted(x, t)
     x_ext = tf.concat((x[:1], x, x[-1:]), axis=0)
     y_ext = tf.concat((y[:1], y, y[-1:]), axis=0)
     dx = x_ext[1:] - x_ext[:-1]
@@ -24,4 +51,4 @@ def interp(t, x, y):
     y0 = tf.gather(y_ext, inds)
     slope = tf.gather(dy / dx, inds)
 
-    return slope * (t - x0) + y0
+    return slope * (t - x0) + y0, slope
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import division, print_function
+
+__all__ = ["TemplateLibrary"]
+
+import os
+import json
+import uuid
+import contextlib
+from time import time
+try:
+    import fcntl
+except ImportError: # not available on Windows
+    fcntl = None
+import numpy as np
+
+c = 2.99792458e8 # m/s
+
+def log_doppler(v):
+    return 0.5 * np.log((1. - v/c) / (1. + v/c))
+
+
+class TemplateLibrary(object):
+    """
+    A persistent store of learned templates (and basis vectors) to start new
+    runs from, in a directory with one .npz file per template plus an index.
+    Templates are keyed by (instrument, order, kind, target), where kind is
+    'star' or 'telluric' and target is '' for tellurics, which are shared by
+    all targets observed with an instrument. The index also holds the
+    wavelength coverage of each template, so that a template can be found for
+    an order by what it covers as well as by its order number.
+
+    Template xs are stored in the frame where the component RVs are zero,
+    i.e. shifted by the RV zero point of the run that learned them
+    (the mean BERV for stars, nothing for tellurics).
+
+    Several runs can share a library: changes re-read the index and write it
+    back under a file lock, so no run loses another's templates. Use times
+    are only written now and then (every used_interval seconds), and not at
+    all if the library is read-only.
+
+    Args:
+        `path`: directory of the library (created if needed)
+        `max_age`: templates not used for this many days are evicted (optional)
+        `max_size`: total size in MB above which the least recently used
+            templates are evicted (optional)
+        `used_interval`: seconds between writes of use times to the index
+    """
+    def __init__(self, path, max_age=None, max_size=None, used_interval=600.):
+        self.path = path
+        self.max_age = max_age
+        self.max_size = max_size
+        self.used_interval = used_interval
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.index_file = os.path.join(path, 'index.json')
+        self.lock_file = os.path.join(path, 'index.lock')
+        self.used = {} # file: time of loads not yet in the index
+        self.used_written = time()
+        self.read_index()
+
+    def read_index(self):
+        self.entries = []
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.entries = json.load(f)
+        for e in self.entries:
+            e['used'] = max(e['used'], self.used.get(e['file'], 0.))
+
+    def write_index(self):
+        tmp = '{0}.{1}.tmp'.format(self.index_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.rename(tmp, self.index_file) # atomic
+
+    @contextlib.contextmanager
+    def update(self):
+        """
+        Hold the library lock, re-read the index so that changes by other
+        runs are kept, and write it back (with pending use times) at the end.
+        """
+        with open(self.lock_file, 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX) # released when the file is closed
+            self.read_index()
+            yield
+            self.write_index()
+            self.used, self.used_written = {}, time()
+
+    def write_used(self):
+        """
+        Write use times of loaded templates to the index; a read-only library
+        is left as it is.
+        """
+        try:
+            with self.update():
+                pass
+        except (IOError, OSError):
+            self.used_written = time() # don't retry on every load
+
+    def find(self, instrument, kind, target='', order=None, coverage=None, min_overlap=0.5):
+        """
+        Best entry for instrument, kind and target: the one for this order if
+        there is one (order keyword), otherwise the one that covers most of the
+        (xmin, xmax) log-wavelength range given by coverage keyword, as long as
+        it covers at least min_overlap of it. Returns None if nothing fits.
+        """
+        self.read_index() # templates added by other runs
+        candidates = [e for e in self.entries if e['instrument'] == instrument and e['kind'] == kind
+                      and e['target'] == target]
+        if order is not None:
+            for e in candidates:
+                if e['order'] == order:
+                    return e
+        if coverage is None:
+            return None
+        xmin, xmax = coverage
+        best, best_overlap = None, min_overlap
+        for e in candidates:
+            overlap = (min(xmax, e['xmax']) - max(xmin, e['xmin'])) / (xmax - xmin)
+            if overlap >= best_overlap:
+                best, best_overlap = e, overlap
+        return best
+
+    def load(self, entry):
+        """
+        Arrays of an entry from find(): template_xs, template_ys and, if the
+        template has any, basis_vectors with the log-wavelengths basis_xs of
+        their pixels. Marks the entry as used.
+        """
+        with np.load(os.path.join(self.path, entry['file'])) as f:
+            arrays = {k: np.copy(f[k]) for k in f.files}
+        entry['used'] = self.used[entry['file']] = time()
+        if entry['used'] - self.used_written > self.used_interval:
+            self.write_used()
+        return arrays
+
+    def resample(self, entry, template_xs, rv_zero=0., basis_xs=None):
+        """
+        Template of an entry interpolated onto template_xs of a run with RV zero
+        point rv_zero, plus its basis vectors interpolated onto the pixel
+        log-wavelengths basis_xs (if given and the template has any).
+        Returns template_ys, basis_vectors (None if not requested) and a mask
+        of the template_xs that the stored template covers.
+        """
+        arrays = self.load(entry)
+        xs = template_xs + log_doppler(rv_zero) # into the stored frame
+        template_ys = np.interp(xs, arrays['template_xs'], arrays['template_ys'])
+        covered = (xs >= arrays['template_xs'][0]) & (xs <= arrays['template_xs'][-1])
+        basis_vectors = None
+        if basis_xs is not None and 'basis_vectors' in arrays:
+            basis_vectors = np.array([np.interp(basis_xs, arrays['basis_xs'], v, left=0., right=0.)
+                                      for v in arrays['basis_vectors']])
+        return template_ys, basis_vectors, covered
+
+    def add(self, instrument, order, kind, template_xs, template_ys, target='', rv_zero=0.,
+            basis_vectors=None, basis_xs=None):
+        """
+        Store a template (replacing any with the same key) and evict old ones.
+        template_xs are in the frame of a run with RV zero point rv_zero;
+        basis_vectors (K x M) need the log-wavelengths basis_xs of their M pixels.
+        """
+        arrays = {'template_xs': np.asarray(template_xs) + log_doppler(rv_zero),
+                  'template_ys': np.asarray(template_ys)}
+        if basis_vectors is not None and np.size(basis_vectors) > 0:
+            arrays['basis_vectors'] = np.asarray(basis_vectors)
+            arrays['basis_xs'] = np.asarray(basis_xs)
+        name = uuid.uuid4().hex + '.npz'
+        filename = os.path.join(self.path, name)
+        np.savez(filename, **arrays) # not in the index yet, so outside the lock
+        with self.update():
+            for e in [e for e in self.entries if (e['instrument'], e['order'], e['kind'], e['target']) ==
+                      (instrument, order, kind, target)]:
+                self.drop(e)
+            now = time()
+            self.entries.append({'instrument': instrument, 'order': int(order), 'kind': kind, 'target': target,
+                                 'xmin': float(arrays['template_xs'][0]), 'xmax': float(arrays['template_xs'][-1]),
+                                 'K': len(arrays.get('basis_vectors', [])), 'file': name,
+                                 'size': os.path.getsize(filename), 'created': now, 'used': now})
+            self.expire()
+
+    def add_results(self, results, instrument, target='', kinds=None):
+        """
+        Store the templates of all components and orders in a Results object.
+        kinds keyword maps component names to 'star' or 'telluric'; by default
+        components with fixed RVs are tellurics and all others are stars.
+        Stars are stored under target, tellurics for all targets.
+        """
+        for name in results.component_names:
+            basename = name + '_'
+            if kinds is not None:
+                kind = kinds[name]
+            else:
+                kind = 'telluric' if getattr(results, basename+'rvs_fixed') else 'star'
+            rv_zero = np.mean(results.bervs) if kind == 'star' else 0.
+            K = int(getattr(results, basename+'K'))
+            for r,order in enumerate(results.orders):
+                basis_vectors, basis_xs = None, None
+                if K > 0:
+                    basis_vectors = getattr(results, basename+'basis_vectors')[r]
+                    basis_xs = np.mean(results.xs[r], axis=0)
+                self.add(instrument, order, kind, getattr(results, basename+'template_xs')[r],
+                         getattr(results, basename+'template_ys')[r], target=target if kind == 'star' else '',
+                         rv_zero=rv_zero, basis_vectors=basis_vectors, basis_xs=basis_xs)
+
+    def remove(self, entry):
+        with self.update():
+            for e in [e for e in self.entries if e['file'] == entry['file']]:
+                self.drop(e)
+
+    def evict(self):
+        """
+        Remove templates unused for more than max_age days, then the least
+        recently used ones until the library is no larger than max_size MB.
+        """
+        with self.update():
+            self.expire()
+
+    def drop(self, entry):
+        # only under update(), so that no other index still has the file
+        self.entries.remove(entry)
+        filename = os.path.join(self.path, entry['file'])
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    def expire(self):
+        if self.max_age is not None:
+            cutoff = time() - self.max_age * 86400.
+            for e in [e for e in self.entries if e['used'] < cutoff]:
+                self.drop(e)
+        if self.max_size is not None:
+            for e in sorted(self.entries, key=lambda e: e['used']):
+                if sum(x['size'] for x in self.entries) <= self.max_size * 2.**20:
+                    break
+                self.drop(e)
@@ -130,11 +130,25 @@ def missing_wavelength_files(filelist):
     return np.unique(missing_files)
     
     
-def write_data(data, ivars, xs, pipeline_rvs, dates, bervs, airms, drifts, hdffile):
+def write_data(data, ivars, xs, pipeline_rvs, dates, bervs, airms, drifts, hdffile, compact=False, degree=4):
+    # compact keyword stores each epoch's wavelength solution as polynomial coefficients
+    # and, where they are constant over each order and epoch (as for HARPS), one ivar per order and epoch
     h = h5py.File(hdffile, 'w')
     dset = h.create_dataset('data', data=data)
-    dset = h.create_dataset('ivars', data=ivars)
-    dset = h.create_dataset('xs', data=xs)
+    if compact:
+        try:
+            from utils import fit_wavelength_solutions # run as a script from this directory
+        except ImportError:
+            from wobble.utils import fit_wavelength_solutions
+        ivars = np.asarray(ivars)
+        if np.all(ivars == ivars[:,:,:1]):
+            ivars = ivars[:,:,0]
+        dset = h.create_dataset('ivars', data=ivars)
+        coeffs = [fit_wavelength_solutions(x, degree=degree) for x in xs]
+        dset = h.create_dataset('wavelength_coeffs', data=coeffs)
+    else:
+        dset = h.create_dataset('ivars', data=ivars)
+        dset = h.create_dataset('xs', data=xs)
     dset = h.create_dataset('pipeline_rvs', data=pipeline_rvs)
     dset = h.create_dataset('dates', data=dates)
     dset = h.create_dataset('bervs', data=bervs)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import division, print_function
+
+__all__ = ["make_data"]
+
+import numpy as np
+import h5py
+
+try:
+    from .utils import fit_wavelength_solutions, wavelength_solutions
+except (ImportError, ValueError): # run as a script from this directory
+    from utils import fit_wavelength_solutions, wavelength_solutions
+
+c = 299792458. # m/s
+
+
+def doppler(rv):
+    beta = rv / c
+    return np.sqrt((1. - beta) / (1. + beta))
+
+def absorption_lines(xs, centers, depths, widths):
+    """
+    Log-flux of a set of Gaussian absorption lines evaluated at log-wavelengths xs.
+    """
+    flux = np.ones_like(xs)
+    for x0, d, w in zip(centers, depths, widths):
+        near = np.abs(xs - x0) < 6. * w
+        flux[near] -= d * np.exp(-0.5 * ((xs[near] - x0) / w)**2)
+    return np.log(np.clip(flux, 0.01, None))
+
+def make_data(filename, N=30, R=2, M=4096, K=0, rv_amplitude=50., period=4.23,
+              telluric_depth=0.3, airmass_range=(1.0, 2.0), snr=100., resolution=1.15e5,
+              lambda_min=5000., seed=42, compact=False):
+    """
+    Write a synthetic data set in the wobble HDF5 format, with known truth.
+
+    Args:
+        `filename`: output HDF5 file
+        `N`: number of epochs
+        `R`: number of orders
+        `M`: pixels per order
+        `K`: number of variable telluric basis vectors
+        `rv_amplitude`: semi-amplitude of the stellar RV signal (m/s)
+        `period`: period of the stellar RV signal (days)
+        `telluric_depth`: maximum depth of telluric lines at airmass 1
+        `airmass_range`: (min, max) of the airmass distribution
+        `snr`: signal-to-noise per pixel at the continuum peak
+        `resolution`: spectral resolution; sets line widths and pixel spacing
+        `lambda_min`: wavelength at the start of the first order (Angstroms)
+        `seed`: random seed
+        `compact`: store the wavelength solutions as polynomial coefficients and 
+            one ivar per epoch and order, as in the compact HARPS format
+
+    The truth is saved alongside the data: `true_rvs` (m/s, the stellar signal
+    without the barycentric correction) and, per order, the rest-frame log-flux
+    of each component (`true_star_ys`, `true_tellurics_ys` on `true_xs`) plus
+    the telluric basis vectors and weights.
+    """
+    rng = np.random.RandomState(seed)
+    dates = 2458000. + np.sort(rng.uniform(0., 365., N))
+    bervs = 3.e4 * np.sin(2. * np.pi * (dates - 2458000.) / 365.25) # m/s
+    true_rvs = rv_amplitude * np.sin(2. * np.pi * dates / period)
+    airms = rng.uniform(airmass_range[0], airmass_range[1], N)
+    drifts = np.zeros(N)
+    pipeline_rvs = true_rvs + bervs # same convention as make_data_2d
+    pipeline_rvs -= np.mean(pipeline_rvs)
+    star_rvs = -bervs - true_rvs # shift into the star rest frame, as applied in wobble
+
+    dx = 1. / (2.5 * resolution) # log-wavelength per pixel
+    line_width = 1. / (2.355 * resolution)
+    pad = 1.e-4 # room for the RV shifts
+    blaze = 1. - 0.5 * np.linspace(-1., 1., M)**2
+
+    with h5py.File(filename, 'w') as f:
+        data = f.create_dataset('data', (R, N, M), dtype='f8')
+        if compact:
+            ivars = f.create_dataset('ivars', (R, N), dtype='f8')
+            coeffs = f.create_dataset('wavelength_coeffs', (R, N, 5), dtype='f8')
+        else:
+            ivars = f.create_dataset('ivars', (R, N, M), dtype='f8')
+            xs = f.create_dataset('xs', (R, N, M), dtype='f8')
+        true_xs = f.create_dataset('true_xs', (R, M), dtype='f8')
+        true_star_ys = f.create_dataset('true_star_ys', (R, M), dtype='f8')
+        true_tellurics_ys = f.create_dataset('true_tellurics_ys', (R, M), dtype='f8')
+        true_basis_vectors = f.create_dataset('true_tellurics_basis_vectors', (R, K, M), dtype='f8')
+        true_basis_weights = f.create_dataset('true_tellurics_basis_weights', (R, N, K), dtype='f8')
+        for r in range(R):
+            x0 = np.log(lambda_min) + r * M * dx
+            order_xs = x0 + dx * np.arange(M)
+            # per-epoch wavelength solutions differ by a small offset and stretch:
+            offsets = rng.normal(0., 3.e-8, N)
+            stretches = rng.normal(0., 1.e-8, N)
+            epoch_xs = order_xs[None, :] + offsets[:, None] + stretches[:, None] * np.linspace(-1., 1., M)[None, :]
+            if compact: # the polynomial solutions are the truth
+                order_coeffs = fit_wavelength_solutions(np.exp(epoch_xs), degree=4)
+                epoch_xs = np.log(wavelength_solutions(order_coeffs, M))
+
+            n_star = M // 20
+            star_lines = (rng.uniform(x0 - pad, order_xs[-1] + pad, n_star), rng.uniform(0.05, 0.7, n_star),
+                          line_width * rng.uniform(1., 2., n_star))
+            n_tell = max(M // 100, 1)
+            tell_lines = (rng.uniform(x0 - pad, order_xs[-1] + pad, n_tell), rng.uniform(0., telluric_depth, n_tell),
+                          line_width * np.ones(n_tell))
+            tell_centers = tell_lines[0]
+            basis = np.zeros((K, M))
+            for k in range(K): # each variable component scales a random subset of the telluric lines
+                ind = rng.rand(n_tell) < 0.3
+                basis[k] = absorption_lines(order_xs, tell_centers[ind], tell_lines[1][ind], tell_lines[2][ind])
+            weights = rng.normal(0., 0.2, (N, K))
+
+            true_xs[r] = order_xs
+            true_star_ys[r] = absorption_lines(order_xs, *star_lines)
+            true_tellurics_ys[r] = absorption_lines(order_xs, *tell_lines)
+            true_basis_vectors[r] = basis
+            true_basis_weights[r] = weights
+
+            order_data = np.empty((N, M))
+            order_ivars = np.empty((N, M))
+            for n in range(N):
+                star_xs = epoch_xs[n] + np.log(doppler(star_rvs[n])) # star rest frame
+                log_flux = absorption_lines(star_xs, *star_lines)
+                log_flux += airms[n] * (absorption_lines(epoch_xs[n], *tell_lines) + np.dot(weights[n], basis))
+                counts = snr**2 * blaze * np.exp(log_flux)
+                order_data[n] = counts + np.sqrt(counts) * rng.randn(M)
+                order_ivars[n] = counts # inverse variance of the log-flux
+            data[r] = order_data
+            if compact:
+                ivars[r] = np.median(order_ivars, axis=1)
+                coeffs[r] = order_coeffs
+            else:
+                ivars[r] = order_ivars
+                xs[r] = np.exp(epoch_xs)
+        f.create_dataset('true_rvs', data=true_rvs)
+        f.create_dataset('pipeline_rvs', data=pipeline_rvs)
+        f.create_dataset('dates', data=dates)
+        f.create_dataset('bervs', data=bervs)
+        f.create_dataset('airms', data=airms)
+        f.create_dataset('drifts', data=drifts)
+
+
+if __name__ == "__main__":
+    make_data('../data/synthetic.hdf5')
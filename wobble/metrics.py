@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import division, print_function
+
+__all__ = ["Metrics", "peak_rss"]
+
+import os
+import sys
+import json
+import contextlib
+from time import time
+import numpy as np
+
+
+def peak_rss():
+    """Peak resident set size of this process in MB"""
+    try:
+        import resource
+    except ImportError: # not available on Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 2.**20 # bytes
+    return rss / 2.**10 # kilobytes
+
+
+class Metrics(object):
+    """
+    Collects performance metrics for optimization runs: wall time per phase,
+    time per optimization step, peak memory and graph size, plus optional
+    TensorFlow step traces. Each measurement is a dictionary ("record") kept
+    in self.records and, if filename is given, appended to it as a JSON line
+    as soon as it is taken, so that long runs can be followed while they go.
+
+    Args:
+        `filename`: JSON-lines file to append records to (optional)
+        `trace_every`: save a TensorFlow timeline for every nth step (0 = never)
+        `trace_dir`: directory for the timeline files (Chrome trace format)
+    """
+    def __init__(self, filename=None, trace_every=0, trace_dir='.'):
+        self.filename = filename
+        self.trace_every = trace_every
+        self.trace_dir = trace_dir
+        self.records = []
+        self.context = {} # added to every record, e.g. the current order
+
+    def emit(self, event, **values):
+        record = dict(self.context, event=event, time=time(), **values)
+        self.records.append(record)
+        if self.filename is not None:
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        return record
+
+    @contextlib.contextmanager
+    def phase(self, name, **values):
+        """
+        Time a phase of the run (a with-block) and record it with the peak RSS afterwards.
+        """
+        start = time()
+        yield
+        self.emit('phase', phase=name, seconds=time() - start, peak_rss_mb=peak_rss(), **values)
+
+    def step(self, i, seconds):
+        self.emit('step', step=i, seconds=seconds)
+
+    def graph(self, graph=None):
+        """
+        Record the number of ops in the TensorFlow graph.
+        """
+        import tensorflow as tf
+        if graph is None:
+            graph = tf.get_default_graph()
+        self.emit('graph', ops=len(graph.get_operations()))
+
+    def tracing(self, i):
+        return self.trace_every > 0 and i % self.trace_every == 0
+
+    def run(self, session, fetches, i, feed_dict=None):
+        """
+        session.run(fetches) for optimization step i, saving a timeline
+        of the run if step i is to be traced.
+        """
+        if not self.tracing(i):
+            return session.run(fetches, feed_dict=feed_dict)
+        import tensorflow as tf
+        from tensorflow.python.client import timeline
+        options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        run_metadata = tf.RunMetadata()
+        out = session.run(fetches, feed_dict=feed_dict, options=options, run_metadata=run_metadata)
+        trace = timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format()
+        name = '_'.join(['{0}{1}'.format(k, v) for k,v in sorted(self.context.items())] + ['step{0}'.format(i)])
+        filename = os.path.join(self.trace_dir, 'timeline_{0}_{1}.json'.format(name,
+                                sum(1 for rec in self.records if rec['event'] == 'trace')))
+        with open(filename, 'w') as f:
+            f.write(trace)
+        self.emit('trace', step=i, filename=filename)
+        return out
+
+    def summary(self):
+        """
+        Total time per phase and statistics of the step times over all records.
+        """
+        summary = {}
+        for rec in self.records:
+            if rec['event'] == 'phase':
+                summary[rec['phase']] = summary.get(rec['phase'], 0.) + rec['seconds']
+        steps = [rec['seconds'] for rec in self.records if rec['event'] == 'step']
+        if len(steps) > 0:
+            summary['step_median'] = float(np.median(steps))
+            summary['step_max'] = float(np.max(steps))
+            summary['steps'] = len(steps)
+        summary['peak_rss_mb'] = peak_rss()
+        return summary
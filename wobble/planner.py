@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import division, print_function
+
+__all__ = ["Planner"]
+
+import json
+import argparse
+import numpy as np
+
+from .utils import wavelength_solutions
+
+# Rough costs for a typical CPU; calibrate() them from benchmarks/suite.py output.
+DEFAULT_COSTS = {
+    'baseline_mb': 400.,                    # python + TensorFlow before any data
+    'step_arrays': 10.,                     # float64 N x M arrays alive per component during a step
+    'step_seconds': 2e-3,                   # fixed cost of an optimization step
+    'step_seconds_per_pixel': 1e-8,         # per epoch-pixel and component
+    'step_seconds_per_basis_pixel': 5e-9,   # per epoch-pixel and basis vector
+    'init_seconds_per_pixel': 5e-8,         # template initialization, per epoch-pixel and component
+    'load_seconds_per_pixel': 5e-8,         # reading and preparing the data, per epoch-pixel
+    'results_seconds_per_pixel': 2e-8,      # copying and writing Results, per epoch-pixel
+}
+
+HISTORY_PIXELS = 4096 # History stores chis and basis vectors at this width
+
+def fit(ys, features):
+    """
+    Non-negative least-squares-ish fit of ys = features . coefficients (negative ones are set to zero).
+    """
+    coeffs = np.linalg.lstsq(np.asarray(features, dtype=float), np.asarray(ys, dtype=float), rcond=None)[0]
+    return np.clip(coeffs, 0., None)
+
+
+class Planner(object):
+    """
+    Predicts the peak memory and run time of a wobble run before it starts,
+    from the shape of a data file and the model and optimization settings,
+    and suggests settings that make a run fit into a memory budget.
+
+    Memory is counted per item: the data held in the session, the cached
+    likelihood pixels, the model parameters and their Adam slots, the History
+    buffers, the Results copies and the largest transient (loading the data,
+    the SVD of the template initialization or the arrays of one step).
+    Run times follow linear cost models whose coefficients can be calibrated
+    on this machine with calibrate().
+
+    Args:
+        `costs`: dictionary overriding entries of DEFAULT_COSTS (optional)
+    """
+    def __init__(self, costs=None):
+        self.costs = dict(DEFAULT_COSTS)
+        if costs is not None:
+            self.costs.update(costs)
+
+    def calibrate(self, records):
+        """
+        Fit the run time coefficients to benchmark records: dictionaries with
+        benchmark, seconds, N, R, M and K as written by benchmarks/suite.py
+        (a star and a telluric component with K basis vectors).
+        Returns the updated costs.
+        """
+        def select(name):
+            return [rec for rec in records if rec['benchmark'] == name]
+        steps = select('optimize_order_step')
+        if len(steps) >= 3:
+            self.costs['step_seconds'], self.costs['step_seconds_per_pixel'], \
+                self.costs['step_seconds_per_basis_pixel'] = fit([rec['seconds'] for rec in steps],
+                    [[1., 2.*rec['N']*rec['M'], rec['N']*rec['M']*rec['K']] for rec in steps])
+        for name, key, per_order in [('initialize_template', 'init_seconds_per_pixel', True),
+                                     ('data_load', 'load_seconds_per_pixel', False),
+                                     ('results_copy', 'results_seconds_per_pixel', False)]:
+            recs = select(name)
+            if len(recs) > 0:
+                pixels = [rec['N']*rec['M']*(2. if per_order else rec['R']) for rec in recs]
+                self.costs[key] = fit([rec['seconds'] for rec in recs], np.array(pixels)[:, None])[0]
+        return self.costs
+
+    @classmethod
+    def from_benchmarks(cls, filename):
+        """
+        Planner calibrated on a JSON-lines file written by benchmarks/suite.py.
+        """
+        with open(filename) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        planner = cls()
+        planner.calibrate(records)
+        return planner
+
+    def inspect(self, filename, orders=None, resolution=None, oversample=3.):
+        """
+        Shape of a wobble HDF5 data file: N, M, the orders (default: all),
+        whether wavelengths and ivars are stored compactly, and the number of
+        template nodes each order will get (see utils.template_grid).
+        """
+        import h5py
+        if resolution is None:
+            dx = 2.*(np.log(6000.01) - np.log(6000.))
+        else:
+            dx = 1. / (oversample * resolution)
+        with h5py.File(filename, 'r') as f:
+            R, N, M = f['data'].shape
+            if orders is None:
+                orders = list(range(R))
+            compact_xs = 'wavelength_coeffs' in f
+            degree = f['wavelength_coeffs'].shape[2] - 1 if compact_xs else None
+            template_sizes = []
+            for o in orders:
+                if compact_xs:
+                    waves = wavelength_solutions(np.array(f['wavelength_coeffs'][o]), M)
+                    lo, hi = np.min(waves[:, 0]), np.max(waves[:, -1])
+                else:
+                    lo, hi = np.min(f['xs'][o, :, 0]), np.max(f['xs'][o, :, -1])
+                template_sizes.append(int((np.log(hi) - np.log(lo)) / dx) + 21) # plus padding
+            return {'filename': filename, 'N': int(N), 'M': int(M), 'orders': list(orders),
+                    'compact_xs': compact_xs, 'degree': degree, 'compact_ivars': f['ivars'].ndim < 3,
+                    'template_sizes': template_sizes}
+
+    def estimate(self, shape, K=0, components=None, niter=100, dtype='float64', save_history=False,
+                 lean_results=False, orders_per_job=None, batch_size=None):
+        """
+        Predicted memory (MB) and run time (s) of fitting the file described by
+        shape (from inspect()).
+
+        Args:
+            `K`: number of telluric basis vectors of the default star + tellurics model
+            `components`: list of the numbers of basis vectors of each component,
+                overrides the default model
+            `niter`: optimization steps per order
+            `dtype`: 'float64' or 'float32', the precision of Data()
+            `save_history`: keep a History of every step
+            `lean_results`: use Results(lean=True)
+            `orders_per_job`: split the orders into separate runs (e.g. jobs in
+                parallel) of this many orders each; memory is per run
+            `batch_size`: optimize on minibatches of epochs streamed from disk
+
+        Returns a dictionary with the memory per item ('memory_mb'), the peak
+        memory per run ('peak_mb'), the time per step ('step_seconds') and
+        in total over all runs ('seconds'), and the number of runs ('jobs').
+        """
+        costs = self.costs
+        Ks = [0, K] if components is None else list(components)
+        C, sumK = len(Ks), sum(Ks)
+        b = 4 if dtype in ['float32', np.float32] else 8
+        N, M = shape['N'], shape['M']
+        R_total = len(shape['orders'])
+        R = R_total if orders_per_job is None else min(orders_per_job, R_total)
+        jobs = int(np.ceil(R_total / R))
+        Mt = int(np.max(shape['template_sizes']))
+        n = N if batch_size is None else min(batch_size, N) # epochs in the graph at once
+        memory = {}
+        if batch_size is None:
+            xs = N * (shape['degree'] + 1) * 8 if shape['compact_xs'] else N * M * 8
+            ivars = N * b if shape['compact_ivars'] else N * M * b
+            memory['data'] = R * (xs + N * M * b + ivars)
+            memory['likelihood_pixels'] = R * N * M * (8 + b) # indices and ys; ivars are gathered on the fly
+            memory['transient_load'] = R * N * M * 8 * 3
+        else:
+            memory['data'] = 4 * n * M * 8 * 3 # prefetched batches
+            memory['likelihood_pixels'] = 0
+            memory['transient_load'] = 0
+        memory['parameters'] = R * sum(Mt * b + 2 * N * 8 + k * M * b + N * k * b for k in Ks)
+        memory['adam_slots'] = 2 * R * sum(Mt * b + N * 8 + k * M * b + N * k * b for k in Ks)
+        memory['transient_step'] = C * costs['step_arrays'] * n * M * 8
+        memory['transient_template_init'] = R * n * (M + Mt) * 8 + 2 * n * Mt * 8
+        memory['history'] = 0
+        if save_history:
+            memory['history'] = niter * 8 * (1 + C * N + C * Mt + sumK * HISTORY_PIXELS + N * sumK
+                                             + N * HISTORY_PIXELS)
+        memory['results'] = R * sum(Mt + 3 * N + k * M + N * k for k in Ks) * 8
+        if not lean_results:
+            memory['results'] += R * N * M * 8 * (4 + C)
+        memory = {k: v / 2.**20 for k,v in memory.items()}
+        transient = max(memory['transient_load'], memory['transient_template_init'], memory['transient_step'])
+        peak = costs['baseline_mb'] + transient + sum(v for k,v in memory.items() if not k.startswith('transient'))
+
+        step = costs['step_seconds'] + n * M * (costs['step_seconds_per_pixel'] * C
+                                                + costs['step_seconds_per_basis_pixel'] * sumK)
+        seconds = R_total * (niter * step + costs['init_seconds_per_pixel'] * N * M * C)
+        seconds += R_total * N * M * (costs['load_seconds_per_pixel'] + costs['results_seconds_per_pixel'])
+        return {'memory_mb': memory, 'peak_mb': peak, 'step_seconds': step, 'seconds': seconds, 'jobs': jobs}
+
+    def suggest(self, shape, budget_mb, **settings):
+        """
+        Settings (keywords of estimate()) that bring the peak memory of a run
+        within budget_mb, trying in turn: no History, lean Results, float32,
+        fewer orders per run and minibatches of epochs. Each change that lowers
+        the peak is kept for the next ones. Returns a list of (description, settings, estimate) for
+        the starting point and each change tried, ending with the first one
+        that fits (or the last one, if none does).
+        """
+        settings = dict(settings)
+        estimate = self.estimate(shape, **settings)
+        steps = [('as given', dict(settings), estimate)]
+        R = len(shape['orders'])
+        changes = [('no History', {'save_history': False}),
+                   ('lean Results', {'lean_results': True}),
+                   ('float32', {'dtype': 'float32'})]
+        changes += [('{0} orders per run'.format(k), {'orders_per_job': k}) for k in [16, 4, 1] if k < R]
+        changes += [('minibatches of {0} epochs'.format(k), {'batch_size': k}) for k in [256, 64, 16]
+                    if k < shape['N']]
+        for description, change in changes:
+            if estimate['peak_mb'] <= budget_mb:
+                break
+            if all(settings.get(k) == v for k,v in change.items()):
+                continue
+            trial = dict(settings, **change)
+            trial_estimate = self.estimate(shape, **trial)
+            if trial_estimate['peak_mb'] >= estimate['peak_mb']: # no help here
+                continue
+            settings, estimate = trial, trial_estimate
+            steps.append((description, dict(settings), estimate))
+        return steps
+
+
+def report(estimate):
+    lines = ["{0:>24s} {1:10.1f} MB".format(k, v) for k,v in sorted(estimate['memory_mb'].items())]
+    lines.append("{0:>24s} {1:10.1f} MB per run ({2} run(s))".format('peak', estimate['peak_mb'], estimate['jobs']))
+    lines.append("{0:>24s} {1:10.4f} s".format('per step', estimate['step_seconds']))
+    lines.append("{0:>24s} {1:10.1f} s".format('total', estimate['seconds']))
+    return '\n'.join(lines)
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Predict the memory use and run time of a wobble run.")
+    parser.add_argument('filename', help="wobble HDF5 data file")
+    parser.add_argument('--orders', help="comma-separated orders (default: all)")
+    parser.add_argument('--K', type=int, default=0, help="telluric basis vectors")
+    parser.add_argument('--niter', type=int, default=100)
+    parser.add_argument('--float32', action='store_true')
+    parser.add_argument('--history', action='store_true', help="save the optimization History")
+    parser.add_argument('--lean', action='store_true', help="lean Results")
+    parser.add_argument('--orders-per-job', type=int)
+    parser.add_argument('--batch-size', type=int)
+    parser.add_argument('--resolution', type=float, help="spectral resolution for the template grid")
+    parser.add_argument('--budget', type=float, help="memory budget in MB: suggest settings that fit")
+    parser.add_argument('--calibration', help="benchmarks/suite.py output to calibrate the run times on")
+    args = parser.parse_args(args)
+
+    planner = Planner() if args.calibration is None else Planner.from_benchmarks(args.calibration)
+    orders = None if args.orders is None else [int(o) for o in args.orders.split(',')]
+    shape = planner.inspect(args.filename, orders=orders, resolution=args.resolution)
+    print("{0}: N={1} epochs, M={2} pixels, {3} orders, template nodes <= {4}".format(
+          args.filename, shape['N'], shape['M'], len(shape['orders']), max(shape['template_sizes'])))
+    settings = {'K': args.K, 'niter': args.niter, 'dtype': 'float32' if args.float32 else 'float64',
+                'save_history': args.history, 'lean_results': args.lean,
+                'orders_per_job': args.orders_per_job, 'batch_size': args.batch_size}
+    if args.budget is None:
+        print(report(planner.estimate(shape, **settings)))
+        return
+    for description, s, estimate in planner.suggest(shape, args.budget, **settings):
+        print("{0:>28s}: {1:.1f} MB per run{2}".format(description, estimate['peak_mb'],
+              '' if estimate['peak_mb'] <= args.budget else ' (over budget)'))
+    print(report(estimate))
+
+if __name__ == "__main__":
+    main()
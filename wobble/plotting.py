@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import division, print_function
+
+__all__ = ["animate", "render", "decimate"]
+
+import os
+import shutil
+import tempfile
+import subprocess
+import multiprocessing
+import numpy as np
+
+
+def frame_steps(niter, nframes=None):
+    """
+    Optimization steps shown in nframes frames (default: all niter steps).
+    """
+    if nframes is None or nframes >= niter:
+        return np.arange(niter)
+    return np.unique(np.linspace(0, niter-1, nframes, dtype=int))
+
+def decimate(xs, ys, max_points):
+    """
+    Min/max decimation of line data for display: the M points of xs and of
+    each row of ys are cut into max_points/2 bins, each drawn as its lowest
+    and highest value, so that nothing narrower than a bin (about a pixel
+    of the output) is lost.
+    Returns xs and ys with at most max_points columns.
+    """
+    M = len(xs)
+    if M <= max_points:
+        return xs, ys
+    starts = np.linspace(0, M, max_points//2, endpoint=False).astype(int)
+    stops = np.append(starts[1:], M) - 1
+    new_xs = np.ravel(np.column_stack((xs[starts], xs[stops])))
+    new_ys = np.empty((len(ys), len(new_xs)))
+    new_ys[:, 0::2] = np.minimum.reduceat(ys, starts, axis=1)
+    new_ys[:, 1::2] = np.maximum.reduceat(ys, starts, axis=1)
+    return new_xs, new_ys
+
+def limits(xs, ys, ylims=None):
+    x_pad = (np.max(xs) - np.min(xs)) * 0.1
+    xlims = (np.min(xs)-x_pad, np.max(xs)+x_pad)
+    if ylims is None:
+        y_pad = (np.max(ys) - np.min(ys)) * 0.1
+        ylims = (np.min(ys)-y_pad, np.max(ys)+y_pad)
+    return xlims, ylims
+
+def setup(fig, xs, ys, steps, linestyle, xlims, ylims):
+    """
+    Draw the first frame on fig, once; returns a function that updates
+    the artists to frame k (row k of ys, optimization step steps[k]).
+    """
+    ax = fig.add_subplot(111)
+    ax.set_xlim(xlims)
+    ax.set_ylim(ylims)
+    title = ax.set_title('')
+    if linestyle == 'scatter':
+        artist = ax.scatter(xs, ys[0])
+        def set_data(k):
+            artist.set_offsets(np.column_stack((xs, ys[k])))
+    elif linestyle == 'line':
+        artist, = ax.plot(xs, ys[0])
+        def set_data(k):
+            artist.set_ydata(ys[k])
+    else:
+        raise ValueError("linestyle not recognized.")
+    def update(k):
+        set_data(k)
+        title.set_text('Optimization step #{0}'.format(steps[k]))
+        return artist, title
+    return update
+
+def prepare(xs, ys, linestyle, nframes, ylims, max_points):
+    steps = frame_steps(len(ys), nframes)
+    ys = ys[steps]
+    xlims, ylims = limits(xs, ys, ylims)
+    if linestyle == 'line':
+        xs, ys = decimate(xs, ys, max_points)
+    return xs, ys, steps, xlims, ylims
+
+def animate(xs, ys, linestyle, nframes=None, ylims=None, max_points=2000):
+    """
+    Generate a matplotlib animation of xs and ys, where ys has one row per optimization step
+    Linestyle options: 'scatter', 'line'
+    Lines are decimated to max_points points (see decimate()).
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib import animation
+    xs, ys, steps, xlims, ylims = prepare(xs, ys, linestyle, nframes, ylims, max_points)
+    fig = plt.figure()
+    update = setup(fig, xs, ys, steps, linestyle, xlims, ylims)
+    ani = animation.FuncAnimation(fig, update, range(len(steps)), interval=150)
+    plt.close(fig)
+    return ani
+
+def render_segment(args):
+    """
+    Render some frames into a video file; run by render() in worker processes.
+    """
+    xs, ys, steps, frames, linestyle, xlims, ylims, filename, fps, dpi, figsize, codec = args
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.animation import FFMpegWriter
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    update = setup(fig, xs, ys, steps, linestyle, xlims, ylims)
+    writer = FFMpegWriter(fps=fps, codec=codec)
+    with writer.saving(fig, filename, dpi):
+        for k in frames:
+            update(k)
+            writer.grab_frame()
+    return filename
+
+def render(xs, ys, linestyle, filename, nframes=None, ylims=None, fps=30, dpi=100, figsize=(6.4, 4.8),
+           codec='libx264', processes=None):
+    """
+    Render the same animation as animate() straight into the video file filename,
+    splitting the frames into contiguous segments that are drawn in parallel
+    worker processes and then joined (without re-encoding) by ffmpeg.
+    Lines are decimated to the output width in pixels.
+    processes keyword defaults to the number of CPUs (at most one per 10 frames).
+    Returns filename.
+    """
+    xs, ys, steps, xlims, ylims = prepare(xs, ys, linestyle, nframes, ylims, max_points=int(2 * figsize[0] * dpi))
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(steps) // 10))
+    segments = np.array_split(np.arange(len(steps)), processes)
+    if processes == 1:
+        return render_segment((xs, ys, steps, segments[0], linestyle, xlims, ylims, filename, fps, dpi, figsize, codec))
+    tmpdir = tempfile.mkdtemp(prefix='wobble-render-')
+    try:
+        jobs = [(xs, ys, steps, frames, linestyle, xlims, ylims, os.path.join(tmpdir, 'segment{0}.mp4'.format(j)),
+                 fps, dpi, figsize, codec) for j,frames in enumerate(segments)]
+        pool = multiprocessing.get_context('spawn').Pool(processes) # no forking of a TensorFlow process
+        try:
+            parts = pool.map(render_segment, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        listfile = os.path.join(tmpdir, 'segments.txt')
+        with open(listfile, 'w') as f:
+            for part in parts:
+                f.write("file '{0}'\n".format(part))
+        from matplotlib import rcParams
+        subprocess.check_call([rcParams['animation.ffmpeg_path'], '-y', '-loglevel', 'error', '-f', 'concat',
+                               '-safe', '0', '-i', listfile, '-c', 'copy', filename])
+    finally:
+        shutil.rmtree(tmpdir)
+    return filename
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import division, print_function
+
+__all__ = ["Results"]
+
+from collections import OrderedDict
+import numpy as np
+
+from .library import log_doppler
+from .writer import write_atomic
+
+DATA_NP_ATTRS = ['N', 'R', 'origin_file', 'orders', 'dates', 'bervs', 'drifts', 'airms', 'pipeline_rvs', 'epoch_mask']
+DATA_TF_ATTRS = ['xs', 'ys', 'ivars']
+MODEL_ATTRS = ['component_names'] # not actually used but defined for completeness
+COMPONENT_NP_ATTRS = ['K', 'rvs_fixed', 'template_exists', 'learning_rate_rvs', 'learning_rate_template', 'learning_rate_basis', 
+                      'L1_template', 'L2_template', 'L1_basis_vectors', 'L2_basis_vectors', 'L2_basis_weights',
+                      'time_rvs', 'order_rvs', 'order_sigmas']
+COMPONENT_TF_ATTRS = ['rvs_block', 'ivars_block', 'template_xs', 'template_ys', 'basis_vectors', 'basis_weights']
+
+
+def write_dataset(f, name, value):
+    """
+    Write value to open hdf5 file f. Lists of arrays with different shapes 
+    (e.g. templates for each order) are stored as a group with one dataset per item.
+    """
+    if type(value) == list and len(set(np.shape(v) for v in value)) > 1:
+        g = f.create_group(name)
+        for i,v in enumerate(value):
+            g.create_dataset(str(i), data=v)
+    else:
+        f.create_dataset(name, data=value)
+
+def read_dataset(f, name):
+    """
+    Read a dataset written by write_dataset() from open hdf5 file f.
+    """
+    if hasattr(f[name], 'keys'): # group
+        return [np.copy(f[name][str(i)]) for i in range(len(f[name]))]
+    return np.copy(f[name])
+
+class LazyOrders(object):
+    """
+    Read-only list of per-order arrays that are computed on access, 
+    e.g. results.ys[r] of lean Results.
+    """
+    def __init__(self, get, R):
+        self.get = get
+        self.R = R
+        
+    def __len__(self):
+        return self.R
+        
+    def __getitem__(self, r):
+        if isinstance(r, slice):
+            return [self.get(i) for i in range(self.R)[r]]
+        return self.get(range(self.R)[r])
+        
+    def __iter__(self):
+        for r in range(self.R):
+            yield self.get(r)
+
+class Results(object):
+    """
+    Numpy copies of the data and learned model. Reading and writing results
+    (and everything else that does not talk to a live Model) works without TensorFlow.
+    
+    lean keyword keeps only the learned parameters (templates, basis vectors and 
+    weights, RVs) and a reference to the data file: xs, ys and ivars are read back 
+    from origin_file, and ys_predicted and <name>_ys_predicted are computed in numpy, 
+    when they are first used. The cache_size most recently used of these per-order 
+    arrays are kept in memory.
+    """
+    def __init__(self, model=None, data=None, filename=None, lean=False, cache_size=8):
+        self.lean = lean
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        if data is not None and model is not None:
+            from .context import scope
+            with scope(model.context):
+                self.copy_data(data)
+                self.copy_model(model)
+        elif filename is not None:
+            self.read(filename)
+        else:
+            print("ERROR: Results() object must have model and data keywords OR filename keyword to initialize.")            
+            
+    def __getattr__(self, attr):
+        """
+        Arrays that lean Results compute on demand.
+        """
+        if attr.startswith('_') or not self.__dict__.get('lean', False):
+            raise AttributeError(attr)
+        if attr in DATA_TF_ATTRS:
+            i = DATA_TF_ATTRS.index(attr)
+            return LazyOrders(lambda r: self.order_data(r)[i], self.R)
+        if attr == 'ys_predicted':
+            return LazyOrders(self.predict, self.R)
+        if attr.endswith('_ys_predicted') and attr[:-len('_ys_predicted')] in self.component_names:
+            name = attr[:-len('_ys_predicted')]
+            return LazyOrders(lambda r: self.predict(r, name=name), self.R)
+        raise AttributeError(attr)
+        
+    def cached(self, key, compute):
+        """
+        compute() through the LRU cache of lean Results.
+        """
+        if key in self._cache:
+            value = self._cache.pop(key)
+        else:
+            value = compute()
+        self._cache[key] = value # most recently used last
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return value
+        
+    def order_data(self, r):
+        """
+        xs, ys and ivars of order r, prepared from origin_file as by Data().
+        """
+        def read():
+            import h5py
+            from .streaming import read_pixels, prepare_pixels, expand_ivars
+            with h5py.File(self.origin_file, 'r') as f:
+                ys, xs, ivars, coeffs = read_pixels(f, self.orders[r], slice(0, self.N))
+            ys, ivars, bad = prepare_pixels(xs, ys, ivars, min_flux=self.min_flux)
+            return xs, ys, expand_ivars(ivars, bad, ys.shape)
+        return self.cached(('data', r), read)
+        
+    def predict(self, r, name=None):
+        """
+        Model prediction for order r in data space: the sum of all components,
+        or that of component name.
+        """
+        if name is None:
+            return self.cached(('predicted', r), 
+                               lambda: sum(self.predict(r, name=n) for n in self.component_names))
+        def synthesize():
+            basename = name+'_'
+            xs = self.order_data(r)[0]
+            if not getattr(self, basename+'template_exists')[r]:
+                return np.zeros_like(xs)
+            shifted_xs = xs + log_doppler(getattr(self, basename+'rvs_block')[r])[:, None]
+            template_xs = getattr(self, basename+'template_xs')[r]
+            template_ys = getattr(self, basename+'template_ys')[r]
+            synth = np.array([np.interp(x, template_xs, template_ys) for x in shifted_xs])
+            if getattr(self, basename+'K') > 0:
+                synth += np.dot(getattr(self, basename+'basis_weights')[r], getattr(self, basename+'basis_vectors')[r])
+            if getattr(self, basename+'kind') == 'telluric':
+                synth *= np.asarray(self.airms)[:, None]
+            return synth
+        return self.cached(('predicted', r, name), synthesize)
+            
+    def copy_data(self, data):
+        for attr in DATA_NP_ATTRS:
+            setattr(self, attr, getattr(data,attr))   
+        if self.lean:
+            assert getattr(data, 'groups', None) is None, "Results: lean results cannot re-read co-added data."
+            self.min_flux = data.min_flux
+            return
+        from .wobble import get_session
+        from .streaming import expand_ivars
+        session = get_session()
+        self.xs, self.ys, self.ivars = [], [], []
+        for r in range(data.R):
+            if isinstance(data.ys[r], np.ndarray): # not in the session yet, see Data.to_tensors()
+                xs, ys = np.asarray(data.xs[r]), np.asarray(data.ys[r])
+                ivars = expand_ivars(np.asarray(data.ivars[r]), data.bad_pixels[r], ys.shape)
+            else:
+                xs, ys, ivars = session.run([data.xs[r], data.ys[r], data.pixel_ivars(r)]) # zero at bad pixels
+            self.xs.append(xs)
+            self.ys.append(ys)
+            self.ivars.append(ivars)
+            
+    def copy_model(self, model):
+        from .wobble import get_session
+        self.component_names = model.component_names
+        session = get_session()
+        if not self.lean:
+            self.ys_predicted = [session.run(model.synthesize(r)) for r in range(self.R)]
+        for c in model.components:
+            basename = c.name+'_'
+            setattr(self, basename+'kind', c.kind)
+            if not self.lean:
+                ys_predicted = [session.run(c.synthesize(r)) for r in range(self.R)]
+                setattr(self, basename+'ys_predicted', ys_predicted)
+            for attr in COMPONENT_NP_ATTRS:
+                setattr(self, basename+attr, getattr(c,attr))
+            for attr in COMPONENT_TF_ATTRS:
+                try:
+                    setattr(self, basename+attr, session.run(getattr(c,attr)))
+                except: # catch when basis vectors are Nones
+                    assert c.K == 0, "Results: copy_model() failed on attribute {0}".format(attr)
+                    
+    def update_order_model(self, model, r):
+        from .context import scope
+        with scope(model.context):
+            self.copy_order_model(model, r)
+            
+    def copy_order_model(self, model, r):
+        from .wobble import get_session
+        session = get_session()
+        if self.lean:
+            for key in [k for k in self._cache if k[0] == 'predicted' and k[1] == r]:
+                del self._cache[key]
+        else:
+            self.ys_predicted[r] = session.run(model.synthesize(r))
+        for c in model.components:
+            basename = c.name+'_'
+            if not self.lean:
+                ys_predicted = session.run(c.synthesize(r))
+                getattr(self, basename+'ys_predicted')[r] = ys_predicted
+            for attr in COMPONENT_NP_ATTRS:
+                if type(getattr(c,attr)) == list: # skip attributes common to all orders
+                    getattr(self, basename+attr)[r] = getattr(c,attr)[r]
+            for attr in COMPONENT_TF_ATTRS:
+                try:
+                    getattr(self, basename+attr)[r] = session.run(getattr(c,attr)[r])
+                except: # catch when basis vectors are Nones
+                    assert c.K == 0, "Results: update_order_model() failed on attribute {0}".format(attr)
+                    
+    def compute_final_rvs(self, model):
+        for c in model.components:
+            if not c.rvs_fixed:
+                c.combine_orders()
+                basename = c.name+'_'
+                setattr(self, basename+'time_rvs', c.time_rvs)
+                setattr(self, basename+'order_rvs', c.order_rvs)
+                setattr(self, basename+'order_sigmas', c.order_sigmas)
+                        
+    def get_rvs(self, name, combined=False):
+        """
+        RVs of component name: (R x N) per-order RVs, or the N time_rvs
+        combined across orders if combined keyword is True.
+        """
+        if combined:
+            return getattr(self, name+'_time_rvs')
+        return getattr(self, name+'_rvs_block')
+                        
+    def read(self, filename):
+        import h5py
+        print("Results: reading from {0}".format(filename))
+        with h5py.File(filename,'r') as f:
+            self.lean = 'lean' in f and bool(f['lean'][()])
+            for attr in DATA_NP_ATTRS:
+                setattr(self, attr, read_dataset(f, attr))
+            if self.lean:
+                self.origin_file = np.asarray(self.origin_file).item()
+                if isinstance(self.origin_file, bytes):
+                    self.origin_file = self.origin_file.decode('utf8')
+                self.min_flux = read_dataset(f, 'min_flux')
+            else:
+                for attr in DATA_TF_ATTRS:
+                    setattr(self, attr, read_dataset(f, attr))
+                self.ys_predicted = read_dataset(f, 'ys_predicted')
+            self.component_names = np.copy(f['component_names'])
+            self.component_names = [a.decode('utf8') for a in self.component_names] # h5py workaround
+            for name in self.component_names:
+                basename = name + '_'
+                if basename+'kind' in f:
+                    setattr(self, basename+'kind', f[basename+'kind'][()].decode('utf8'))
+                else: # older files
+                    setattr(self, basename+'kind', 'telluric' if np.copy(f[basename+'rvs_fixed']) else 'star')
+                for attr in np.append(COMPONENT_NP_ATTRS, COMPONENT_TF_ATTRS):
+                    try:
+                        setattr(self, basename+attr, read_dataset(f, basename+attr))
+                    except: # catch when basis vectors are Nones
+                        assert np.copy(f[basename+'K']) == 0, "Results: read() failed on attribute {0}".format(basename+attr)
+                if not self.lean:
+                    setattr(self, basename+'ys_predicted', read_dataset(f, basename+'ys_predicted'))
+                    
+    def write(self, filename, writer=None):
+        """
+        Write to hdf5 (atomically). writer keyword takes a BackgroundWriter to 
+        write a snapshot of the current results in the background instead.
+        """
+        print("Results: writing to {0}".format(filename))
+        values = {attr: getattr(self, attr) for attr in vars(self) if not attr.startswith('_')} # not the cache
+        if writer is None:
+            write_atomic(filename, write_results, values)
+        else:
+            writer.submit(filename, write_results, {attr: snapshot(attr, value) for attr, value in values.items()})
+            
+def snapshot(attr, value):
+    """
+    Copy of the Results attribute value that later updates cannot change: 
+    update_order_model() replaces the arrays of each order (or sets array
+    items), so lists and arrays of model attributes are copied one level 
+    deep, while the data, which never change, are shared.
+    """
+    if attr in DATA_NP_ATTRS or attr in DATA_TF_ATTRS:
+        return value
+    if isinstance(value, list):
+        return list(value)
+    if isinstance(value, np.ndarray):
+        return np.copy(value)
+    return value
+
+def write_results(filename, values):
+    """
+    Write the attributes values (a dictionary) of Results to filename.
+    """
+    import h5py
+    with h5py.File(filename,'w') as f:
+        for attr, value in values.items():
+            if attr == 'component_names':
+                f.create_dataset(attr, data=[a.encode('utf8') for a in value]) # h5py workaround
+            elif attr.endswith('_kind'):
+                f.create_dataset(attr, data=str(value).encode('utf8'))
+            else:
+                write_dataset(f, attr, value)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import division, print_function
+
+__all__ = ["SharedArrays"]
+
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+
+
+class SharedArrays(object):
+    """
+    Named numpy arrays published once into a scratch directory, as .npy files
+    that any process can map read-only without copying or re-reading them.
+    By default the directory is made in shared memory (/dev/shm) where there
+    is one, so the arrays never touch the disk.
+
+    The process that publishes the arrays owns the directory and removes it
+    with close() (or at the end of a with-block); processes that attach() to
+    it only read from it. Use path to hand the arrays to other processes.
+    """
+    def __init__(self, path, owner=False):
+        self.path = path
+        self.owner = owner
+        with open(os.path.join(path, 'info.json')) as f:
+            info = json.load(f)
+        self.names = info.pop('_names')
+        self.info = info
+        self.arrays = {}
+
+    @classmethod
+    def publish(cls, arrays, info=None, path=None):
+        """
+        Write arrays (a dictionary of numpy arrays) and info (a dictionary of
+        JSON-compatible values) into path, by default a new scratch directory.
+        """
+        if path is None:
+            shm = '/dev/shm'
+            path = tempfile.mkdtemp(prefix='wobble-', dir=shm if os.path.isdir(shm) else None)
+        elif not os.path.isdir(path):
+            os.makedirs(path)
+        for name, value in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), np.asarray(value))
+        info = dict(info or {}, _names=sorted(arrays))
+        with open(os.path.join(path, 'info.json'), 'w') as f:
+            json.dump(info, f)
+        return cls(path, owner=True)
+
+    @classmethod
+    def attach(cls, path):
+        return cls(path, owner=False)
+
+    def __getitem__(self, name):
+        """
+        Read-only memory map of array name.
+        """
+        if name not in self.arrays:
+            self.arrays[name] = np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+        return self.arrays[name]
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def close(self):
+        """
+        Drop the memory maps; the owner also removes the published files.
+        Arrays still in use elsewhere stay valid until they are released.
+        """
+        self.arrays = {}
+        if self.owner and os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import division, print_function
+
+__all__ = ["read_pixels", "prepare_pixels", "expand_ivars", "EpochReader", "Prefetcher", "epoch_batches"]
+
+import threading
+try:
+    import queue
+except ImportError: # python 2
+    import Queue as queue
+import numpy as np
+import h5py
+
+from .utils import fit_continuum, wavelength_solutions
+
+
+def read_pixels(f, order, epochs):
+    """
+    Read the spectra of some epochs of an order from an open wobble HDF5 file f.
+    Wavelengths are stored either per pixel ('xs') or as polynomial wavelength
+    solutions ('wavelength_coeffs', see utils.fit_wavelength_solutions), and
+    ivars per pixel, per epoch (R x N) or per order (R).
+
+    Args:
+        `f`: open h5py File
+        `order`: index of the order in the file
+        `epochs`: slice or sorted list of epoch indices
+
+    Returns:
+        `ys`: fluxes (n_epochs x M)
+        `xs`: log-wavelengths (n_epochs x M)
+        `ivars`: ivars, (n_epochs x M) or (n_epochs x 1) if stored compactly
+        `coeffs`: wavelength solutions (n_epochs x degree+1), or None if not stored
+    """
+    ys = np.array(f['data'][order, epochs, :], dtype=np.float64)
+    n, M = ys.shape
+    if 'wavelength_coeffs' in f:
+        coeffs = np.array(f['wavelength_coeffs'][order, epochs, :], dtype=np.float64)
+        xs = np.log(wavelength_solutions(coeffs, M))
+    else:
+        coeffs = None
+        xs = np.log(np.array(f['xs'][order, epochs, :], dtype=np.float64))
+    if f['ivars'].ndim == 3:
+        ivars = np.array(f['ivars'][order, epochs, :], dtype=np.float64)
+    elif f['ivars'].ndim == 2:
+        ivars = np.array(f['ivars'][order, epochs], dtype=np.float64)[:, None]
+    else:
+        ivars = np.zeros((n, 1)) + f['ivars'][order]
+    return ys, xs, ivars, coeffs
+
+def prepare_pixels(xs, ys, ivars, min_flux=1.):
+    """
+    Prepare spectra from read_pixels() for fitting: pixels with less than
+    min_flux get zero weight, then the fluxes are logged and continuum normalized.
+    Full ivars are zeroed at those pixels, while compact ivars stay compact:
+    the pixels are also returned as a sparse index (see expand_ivars()).
+    Returns ys, ivars and bad, the flat indices into (n_epochs x M) of the
+    zero-weight pixels.
+    """
+    bad = ys < min_flux
+    ys[bad] = min_flux
+    if ivars.shape == ys.shape:
+        ivars[bad] = 0.
+    ys = np.log(ys)
+    for n in range(len(ys)):
+        ys[n] -= fit_continuum(xs[n], ys[n], np.where(bad[n], 0., ivars[n]))
+    return ys, ivars, np.flatnonzero(bad)
+
+def expand_ivars(ivars, bad, shape):
+    """
+    ivars (possibly compact) at every pixel of shape, with zero weight at the
+    flat indices bad from prepare_pixels().
+    """
+    ivars = ivars * np.ones(shape)
+    if bad is not None:
+        ivars.flat[bad] = 0.
+    return ivars
+
+
+def epoch_batches(epochs, batch_size, nbatches, seed=None):
+    """
+    Random batches of the given epoch indices: each pass through the epochs
+    is a new shuffle, and the epochs left over at the end of a pass go into
+    a batch with the first ones of the next pass (without repeats), so every
+    epoch is used once per pass. Yields nbatches sorted arrays of batch_size
+    indices (all epochs if there are fewer).
+    """
+    rng = np.random.RandomState(seed)
+    epochs = np.asarray(epochs)
+    batch_size = min(batch_size, len(epochs))
+    order, start = rng.permutation(epochs), 0
+    for b in range(nbatches):
+        batch = order[start:start+batch_size]
+        start += batch_size
+        if len(batch) < batch_size: # next pass
+            order, start = rng.permutation(epochs), 0
+            fill = order[~np.isin(order, batch)][:batch_size - len(batch)]
+            order = order[~np.isin(order, fill)] # the rest of the next pass
+            batch = np.concatenate([batch, fill])
+        yield np.sort(batch)
+
+
+class EpochReader(object):
+    """
+    Reads epochs of one order straight from a wobble HDF5 file and prepares
+    them the same way as Data(): bad pixels masked, log flux, continuum normalized.
+
+    Args:
+        `filename`: HDF5 file in the format read by Data()
+        `order`: index of the order in the file
+        `min_flux`: pixels with less flux get zero weight
+    """
+    def __init__(self, filename, order, min_flux=1.):
+        self.filename = filename
+        self.order = order
+        self.min_flux = min_flux
+        self.file = None # opened on first read, in the thread that reads
+
+    def read(self, epochs):
+        """
+        xs, ys and ivars (each n_epochs x M, or n_epochs x 1 for compact ivars) 
+        for a sorted array of epoch indices.
+        """
+        if self.file is None:
+            self.file = h5py.File(self.filename, 'r')
+        epochs = list(epochs) # h5py wants increasing indices
+        ys, xs, ivars, coeffs = read_pixels(self.file, self.order, epochs)
+        ys, ivars, bad = prepare_pixels(xs, ys, ivars, min_flux=self.min_flux)
+        if len(bad) > 0: # a batch is small enough to mark them in full ivars
+            ivars = expand_ivars(ivars, bad, ys.shape)
+        return xs, ys, ivars
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class Prefetcher(object):
+    """
+    Reads batches of epochs in a background thread and keeps up to size of
+    them ready, so that reading and preparing the data overlaps with the
+    optimization. Iterating gives (epochs, (xs, ys, ivars)) for each batch.
+
+    Args:
+        `reader`: EpochReader
+        `batches`: iterable of epoch index arrays, e.g. from epoch_batches()
+        `size`: maximum number of batches held in memory
+    """
+    def __init__(self, reader, batches, size=4):
+        self.reader = reader
+        self.queue = queue.Queue(maxsize=size)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.work, args=(batches,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def work(self, batches):
+        try:
+            for epochs in batches:
+                if self.stopped.is_set():
+                    break
+                self.put((epochs, self.reader.read(epochs)))
+        except Exception as e: # hand it over to the consumer
+            self.put(e)
+        finally:
+            self.reader.close()
+        self.put(None) # done
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
@@ -2,10 +2,11 @@
 
 from __future__ import division, print_function
 
-__all__ = ["load_op_library"]
+__all__ = ["load_op_library", "jit_scope"]
 
 import os
 import sysconfig
+import contextlib
 import tensorflow as tf
 
 
@@ -18,3 +19,14 @@ def load_op_library(module_file, name):
     else:
         libfile += ".so"
     return tf.load_op_library(libfile)
+
+
+@contextlib.contextmanager
+def jit_scope(compile=True):
+    """Mark the ops created in this scope for XLA compilation (if compile)"""
+    if not compile:
+        yield
+        return
+    from tensorflow.contrib.compiler import jit
+    with jit.experimental_jit_scope():
+        yield
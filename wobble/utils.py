@@ -2,7 +2,8 @@
 
 from __future__ import division, print_function
 
-__all__ = ["fit_continuum", "bin_data"]
+__all__ = ["fit_continuum", "bin_data", "bin_data_orders", "template_grid", "chunk_columns", "chunk_taper", 
+           "randomized_svd", "fit_wavelength_solutions", "wavelength_solutions"]
 
 import numpy as np
 
@@ -39,7 +40,7 @@ def fit_continuum(x, y, ivars, order=6, nsigma=[0.3,3.0], maxniter=50):
 
 def bin_data(xs, ys, xps):
     """
-    Bin data onto a uniform grid using medians.
+    Bin data onto a grid using medians.
     
     Args:
         `xs`: `[N, M]` array of xs
@@ -50,13 +51,182 @@ def bin_data(xs, ys, xps):
         `yps`: `M'` grid of y-primes
     
     """
-    all_ys, all_xs = np.ravel(ys), np.ravel(xs)
-    dx = xps[1] - xps[0] # ASSUMES UNIFORM GRID
-    yps = np.zeros_like(xps)
-    for i,t in enumerate(xps):
-        ind = (all_xs >= t-dx/2.) & (all_xs < t+dx/2.)
-        if np.sum(ind) > 0:
-            yps[i] = np.nanmedian(all_ys[ind])
-    ind_nan = np.isnan(yps)
-    yps.flat[ind_nan] = np.interp(xps[ind_nan], xps[~ind_nan], yps[~ind_nan])
-    return xps, yps
\ No newline at end of file
+    return xps, bin_data_orders([xs], [ys], [xps])[0]
+
+def bin_edges(xps):
+    """
+    Edges of the bins around each point of a grid.
+    """
+    mids = 0.5 * (xps[1:] + xps[:-1])
+    return np.concatenate(([xps[0] - (mids[0] - xps[0])], mids, [xps[-1] + (xps[-1] - mids[-1])]))
+
+def template_grid(xs, ivars=None, ys=None, dx=None, resolution=None, oversample=3., pad=10, 
+                  trim=False, coarse_tol=None, coarse_factor=4):
+    """
+    Make a grid of template nodes covering the data.
+    
+    Args:
+        `xs`: `[N, M]` array of (rest-frame) xs
+        `ivars`: `[N, M]` array of ivars; pixels with zero weight are ignored
+        `ys`: `[N, M]` array of ys, needed for `coarse_tol`
+        `dx`: node spacing; defaults to `1/(oversample*resolution)`, or to 
+            the fixed spacing used by earlier versions if `resolution` is None
+        `resolution`: spectral resolution of the instrument
+        `oversample`: number of nodes per resolution element
+        `pad`: number of nodes kept beyond the data, to leave room for RV shifts
+        `trim`: drop nodes more than `pad` nodes away from any data, e.g. in gaps
+        `coarse_tol`: if given, thin out the nodes in featureless stretches: 
+            an interval between every `coarse_factor`-th node keeps only its 
+            end points if linear interpolation between them reproduces the 
+            binned data to within `coarse_tol`
+        `coarse_factor`: spacing (in nodes) of the coarse grid
+    
+    Returns:
+        `xps`: grid of template xs
+    
+    """
+    if dx is None:
+        if resolution is None:
+            dx = 2.*(np.log(6000.01) - np.log(6000.)) # log-uniform spacing
+        else:
+            dx = 1. / (oversample * resolution)
+    if ivars is not None:
+        good = np.broadcast_to(ivars, np.shape(xs)) > 0
+        xs = xs[good]
+        if ys is not None:
+            ys = ys[good]
+    xps = np.arange(np.min(xs) - pad*dx, np.max(xs) + pad*dx, dx)
+    if trim:
+        counts = np.bincount(np.floor((np.ravel(xs) - xps[0]) / dx + 0.5).astype(int), minlength=len(xps))
+        covered = np.convolve(counts[:len(xps)] > 0, np.ones(2*pad+1), mode='same') > 0
+        xps = xps[covered]
+    if coarse_tol is not None:
+        assert ys is not None, "template_grid: coarse_tol requires ys."
+        yps = bin_data(xs, ys, xps)[1]
+        inds = np.arange(len(xps))
+        coarse = np.unique(np.append(inds[::coarse_factor], inds[-1]))
+        smooth = np.abs(np.interp(xps, xps[coarse], yps[coarse]) - yps) < coarse_tol
+        interval = np.searchsorted(coarse, inds, side='right') - 1
+        interval_smooth = np.ones(len(coarse), dtype=bool)
+        np.logical_and.at(interval_smooth, interval, smooth)
+        xps = xps[~interval_smooth[interval] | np.isin(inds, coarse)]
+    return xps
+
+def bin_data_orders(xs, ys, xps):
+    """
+    Bin data for several orders onto grids using medians, all in one 
+    vectorized pass (a single sort of every pixel by bin and value).
+    Each bin spans the midpoints between its node and the neighboring ones.
+    Bins without data are set to zero.
+    
+    Args:
+        `xs`: list of `[N, M]` arrays of xs, one per order
+        `ys`: list of `[N, M]` arrays of ys, one per order
+        `xps`: list of grids of x-primes, one per order
+    
+    Returns:
+        `yps`: list of grids of y-primes, one per order
+    
+    """
+    offsets = np.cumsum([0] + [len(xp) for xp in xps])
+    all_bins, all_ys = [], []
+    for x, y, xp, offset in zip(xs, ys, xps, offsets):
+        x, y = np.ravel(x), np.ravel(y)
+        bins = np.searchsorted(bin_edges(xp), x, side='right') - 1
+        good = (bins >= 0) & (bins < len(xp)) & ~np.isnan(y)
+        all_bins.append(bins[good] + offset)
+        all_ys.append(y[good])
+    all_bins, all_ys = np.concatenate(all_bins), np.concatenate(all_ys)
+    order = np.lexsort((all_ys, all_bins))
+    all_bins, all_ys = all_bins[order], all_ys[order]
+    counts = np.bincount(all_bins, minlength=offsets[-1])
+    starts = np.cumsum(counts) - counts
+    full = counts > 0
+    lo = starts[full] + (counts[full] - 1) // 2 # the two middle values, same for odd counts
+    hi = starts[full] + counts[full] // 2
+    yps = np.zeros(offsets[-1])
+    yps[full] = 0.5 * (all_ys[lo] + all_ys[hi])
+    return [yps[a:b] for a,b in zip(offsets[:-1], offsets[1:])]
+
+def chunk_columns(M, n_chunks, overlap=128):
+    """
+    Split M pixel columns into n_chunks chunks that overlap by overlap columns.
+    
+    Returns:
+        `bounds`: the n_chunks+1 boundaries between the chunk cores (for chunk_taper())
+        `columns`: list of (start, stop) column ranges, one per chunk
+    
+    """
+    bounds = np.linspace(0., M, n_chunks+1)
+    assert overlap < M / n_chunks, "chunk_columns: overlap must be smaller than the chunks."
+    columns = [(max(0, int(np.floor(bounds[k] - overlap/2.))), min(M, int(np.ceil(bounds[k+1] + overlap/2.))))
+               for k in range(n_chunks)]
+    return bounds, columns
+
+def chunk_taper(positions, bounds, k, overlap=128):
+    """
+    Weight of chunk k at (fractional) column positions: linear ramps across 
+    each overlap, so that the weights of all chunks add up to one everywhere.
+    """
+    weights = np.ones_like(positions, dtype=float)
+    if k > 0:
+        weights *= np.clip((positions - bounds[k] + overlap/2.) / overlap, 0., 1.)
+    if k < len(bounds) - 2:
+        weights *= np.clip((bounds[k+1] + overlap/2. - positions) / overlap, 0., 1.)
+    return weights
+
+def randomized_svd(A, K, oversample=10, n_iter=2, seed=None):
+    """
+    Approximate the leading K singular vectors of a matrix with a randomized 
+    range finder followed by a small SVD (Halko, Martinsson & Tropp 2011).
+    
+    Args:
+        `A`: `[N, M]` array
+        `K`: number of singular values/vectors to compute
+        `oversample`: extra random directions used to find the range of A
+        `n_iter`: number of power iterations; more are needed when the 
+            singular values decay slowly
+        `seed`: random seed
+    
+    Returns:
+        `u`: `[N, K]` array of left singular vectors
+        `s`: `K` singular values
+        `v`: `[K, M]` array of right singular vectors
+    
+    """
+    rng = np.random.RandomState(seed)
+    L = min(K + oversample, *A.shape)
+    Q = np.linalg.qr(np.dot(A, rng.randn(A.shape[1], L)))[0]
+    for i in range(n_iter): # re-orthonormalize at each step for stability
+        Q = np.linalg.qr(np.dot(A.T, Q))[0]
+        Q = np.linalg.qr(np.dot(A, Q))[0]
+    u, s, v = np.linalg.svd(np.dot(Q.T, A), full_matrices=False)
+    return np.dot(Q, u[:,:K]), s[:K], v[:K,:]
+
+def fit_wavelength_solutions(wavelengths, degree=4):
+    """
+    Compact form of per-epoch wavelength solutions: polynomial coefficients 
+    (highest power first, as in np.polyval) in the scaled pixel coordinate 
+    t = np.linspace(-1, 1, M).
+    
+    Args:
+        `wavelengths`: `[N, M]` array of wavelengths
+        `degree`: degree of the polynomials
+    
+    Returns:
+        `coeffs`: `[N, degree+1]` array of coefficients
+    
+    """
+    t = np.linspace(-1., 1., np.shape(wavelengths)[1])
+    return np.polyfit(t, np.transpose(wavelengths), degree).T
+
+def wavelength_solutions(coeffs, M):
+    """
+    Evaluate the polynomial wavelength solutions from fit_wavelength_solutions() 
+    on M pixels; returns an `[N, M]` array of wavelengths.
+    """
+    t = np.linspace(-1., 1., M)
+    wavelengths = np.zeros((len(coeffs), M))
+    for c in np.transpose(coeffs):
+        wavelengths = wavelengths * t + c[:, None]
+    return wavelengths
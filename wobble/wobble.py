@@ -1,34 +1,35 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib
-from matplotlib import animation
 from tqdm import tqdm
 import sys
 import h5py
-import copy
 import pickle
+import copy
+from time import time
 import tensorflow as tf
-T = tf.float64
-import pdb
+T = tf.float64 # default precision; RVs are always kept at this precision
 
-from .utils import fit_continuum, bin_data
-from .interp import interp
+from .utils import fit_continuum, bin_data_orders, template_grid, chunk_columns, chunk_taper, randomized_svd, \
+                   wavelength_solutions
+from .results import Results
+from .interp import interp_with_slope
+from .tf_utils import jit_scope
+from .metrics import Metrics
+from .streaming import read_pixels, prepare_pixels, expand_ivars, EpochReader, Prefetcher, epoch_batches
+from .shared import SharedArrays
+from .context import Context, scope, in_context
+from .writer import BackgroundWriter, write_atomic
 
 speed_of_light = 2.99792458e8   # m/s
-DATA_NP_ATTRS = ['N', 'R', 'origin_file', 'orders', 'dates', 'bervs', 'drifts', 'airms', 'pipeline_rvs', 'epoch_mask']
-DATA_TF_ATTRS = ['xs', 'ys', 'ivars']
-MODEL_ATTRS = ['component_names'] # not actually used but defined for completeness
-COMPONENT_NP_ATTRS = ['K', 'rvs_fixed', 'template_exists', 'learning_rate_rvs', 'learning_rate_template', 'learning_rate_basis', 
-                      'L1_template', 'L2_template', 'L1_basis_vectors', 'L2_basis_vectors', 'L2_basis_weights',
-                      'time_rvs', 'order_rvs', 'order_sigmas']
-COMPONENT_TF_ATTRS = ['rvs_block', 'ivars_block', 'template_xs', 'template_ys', 'basis_vectors', 'basis_weights']
 
-__all__ = ["get_session", "doppler", "Data", "Model", "History", "Results", "optimize_order", "optimize_orders"]
+__all__ = ["get_session", "Context", "doppler", "Data", "Model", "History", "Results", "optimize_order", "optimize_orders",
+           "optimize_order_chunked", "optimize_order_minibatch", "optimize_order_multires", "optimize_rvs_order", 
+           "infer_rvs", "optimize_orders_coadded", "compare_precision", "compare_chunk_modes", 
+           "compare_multires"]
 
 def get_session():
   """Get the globally defined TensorFlow session.
   If the session is not already defined, then the function will create
-  a global session.
+  a global session. Inside a Context, this is the session of the context.
   Returns:
     _SESSION: tf.Session.
   (Code from edward package.)
@@ -47,66 +48,445 @@ def doppler(v):
     frac = (1. - v/speed_of_light) / (1. + v/speed_of_light)
     return tf.sqrt(frac)
 
+def doppler_np(v):
+    """
+    Numpy version of doppler().
+    """
+    frac = (1. - v/speed_of_light) / (1. + v/speed_of_light)
+    return np.sqrt(frac)
+
+def reduce_sum64(x, **kwargs):
+    """
+    Sum in float64 regardless of the precision of x.
+    """
+    return tf.reduce_sum(tf.cast(x, tf.float64), **kwargs)
+
+def data_variable(value, dtype, name=None):
+    """
+    Non-trainable variable holding the numpy array value. It is filled through 
+    a placeholder, so that the values live in the session only and are not 
+    written into the graph (as they would be by tf.constant). It is kept out of 
+    all collections, so variable initializers leave it alone.
+    """
+    placeholder = tf.placeholder(dtype, shape=np.shape(value))
+    var = tf.Variable(placeholder, trainable=False, collections=[], name=name)
+    get_session().run(var.initializer, feed_dict={placeholder: value})
+    return var
+
+def group_updates(updates, steps=[]):
+    """
+    One op for a whole training step: applies updates, a list of (optimizer, 
+    grads_and_vars), and adds steps, a list of (variable, step tensor), but only 
+    once all of their gradients and steps are computed. So every update sees the 
+    same values of the variables, as if they were made at the same time, with 
+    no race between the reads of one and the writes of another.
+    """
+    reads = [s for _,s in steps]
+    for _,gvs in updates:
+        for g,_ in gvs:
+            if isinstance(g, tf.IndexedSlices): # sparse gradient
+                reads += [g.values, g.indices]
+            elif g is not None:
+                reads.append(g)
+    with tf.control_dependencies(reads):
+        ops = [optimizer.apply_gradients(gvs) for optimizer,gvs in updates]
+        ops += [tf.assign_add(v, s) for v,s in steps]
+    return tf.group(*ops)
+
+def poly_log_wavelengths(coeffs, M):
+    """
+    Log-wavelengths (N x M) of the polynomial wavelength solutions coeffs 
+    (see utils.fit_wavelength_solutions), computed in the graph whenever 
+    they are needed rather than stored.
+    """
+    t = tf.constant(np.linspace(-1., 1., M), dtype=tf.float64)
+    c = data_variable(coeffs, tf.float64, name='wavelength_coeffs')
+    wavelengths = c[:, :1] * tf.ones_like(t)[None, :]
+    for k in range(1, coeffs.shape[1]):
+        wavelengths = wavelengths * t + c[:, k:k+1]
+    return tf.log(wavelengths)
+
+def dlogdoppler_dv(v):
+    """
+    Derivative of log(doppler(v)) with respect to v.
+    """
+    return -1. / (speed_of_light * (1. - (v/speed_of_light)**2))
+
 class Data(object):
     """
     The data object: contains the spectra and associated data.
+    dtype keyword sets the precision of the ys and ivars, and of all model 
+    computations in data space (tf.float32 roughly halves memory and time).
+    The log-wavelengths xs are always stored in float64.
+    stream keyword only reads the per-epoch metadata; the spectra stay on disk 
+    and are read in batches of epochs by optimize_order_minibatch().
+    Files can store the wavelengths as polynomial wavelength solutions and the 
+    ivars per epoch or per order (see streaming.read_pixels); these are kept 
+    in compact form, so that xs are computed from the polynomials on the fly 
+    and ivars have shape (N x 1) where possible; pixels with less than min_flux 
+    are then listed in bad_pixels instead (see pixel_ivars()).
+    context keyword takes a Context to hold the data tensors and everything built 
+    on them (Models, optimization); by default they go to the global session.
     """
     def __init__(self, filename, filepath='../data/', 
                     N = 0, orders = [30], min_flux = 1., tensors=True,
-                    mask_epochs = None):
+                    mask_epochs = None, dtype=T, stream=False, context=None):
+        self.T = dtype
+        self.context = context
         self.R = len(orders) # number of orders to be analyzed
         self.orders = orders
         self.origin_file = filepath+filename
+        self.min_flux = min_flux
+        self.stream = stream
+        self.order_indices = list(range(self.R)) # see subset()
         with h5py.File(self.origin_file) as f:
             if N < 1:
                 self.N = len(f['dates']) # all epochs
             else:
                 self.N = N
-            self.ys = [f['data'][i][:self.N,:] for i in orders]
-            self.xs = [np.log(f['xs'][i][:self.N,:]) for i in orders]
-            self.ivars = [f['ivars'][i][:self.N,:] for i in orders]
+            if not stream:
+                self.ys, self.xs, self.ivars, self.wavelength_coeffs, self.bad_pixels = [], [], [], [], []
+                for i in orders:
+                    ys, xs, ivars, coeffs = read_pixels(f, i, slice(0, self.N))
+                    # mask out bad pixels, log and normalize:
+                    ys, ivars, bad = prepare_pixels(xs, ys, ivars, min_flux=min_flux)
+                    self.ys.append(ys)
+                    self.xs.append(xs)
+                    self.ivars.append(ivars)
+                    self.wavelength_coeffs.append(coeffs)
+                    self.bad_pixels.append(bad)
             self.pipeline_rvs = np.copy(f['pipeline_rvs'])[:self.N] * -1.
             self.dates = np.copy(f['dates'])[:self.N]
             self.bervs = np.copy(f['bervs'])[:self.N] * -1.
             self.drifts = np.copy(f['drifts'])[:self.N]
             self.airms = np.copy(f['airms'])[:self.N]
             
-        # mask out bad pixels:
-        for r in range(self.R):
-            bad = np.where(self.ys[r] < min_flux)
-            self.ys[r][bad] = min_flux
-            self.ivars[r][bad] = 0.
-            
         # mask out bad epochs:
         self.epoch_mask = [True for n in range(self.N)]
         if mask_epochs is not None:
             for n in mask_epochs:
                 self.epoch_mask[n] = False
-
-        # log and normalize:
-        self.ys = np.log(self.ys) 
-        self.continuum_normalize() 
+        self.compact_cache = {} # shared by views and shallow copies with other epoch masks
+        if stream:
+            self.xs, self.ys, self.ivars = [None] * self.R, [None] * self.R, [None] * self.R
+            self.wavelength_coeffs, self.bad_pixels = [None] * self.R, [None] * self.R
+            return
+        
+        if tensors:
+            self.to_tensors()
+            
+    @in_context
+    def to_tensors(self, orders=None):
+        """
+        Convert the numpy data arrays to tensors (held in the session, not in the graph).
+        orders keyword (indices r) defaults to all orders; orders that already 
+        are tensors are left alone, so this can be called before every use.
+        """
+        if orders is None:
+            orders = range(self.R)
+        for r in orders:
+            if not isinstance(self.ys[r], np.ndarray):
+                continue
+            c = self.wavelength_coeffs[r]
+            if c is None:
+                self.xs[r] = data_variable(self.xs[r], tf.float64, name='xs')
+            else:
+                self.xs[r] = poly_log_wavelengths(c, np.shape(self.ys[r])[1])
+            self.ys[r] = data_variable(self.ys[r], self.T, name='ys')
+            self.ivars[r] = data_variable(self.ivars[r], self.T, name='ivars')
+            if self.bad_pixels[r] is not None:
+                self.bad_pixels[r] = data_variable(self.bad_pixels[r], tf.int64, name='bad_pixels')
+        
+    @in_context
+    def publish(self, path=None):
+        """
+        Publish the prepared data once into shared memory (or the directory path) 
+        so that worker processes can attach to it with Data.attach(path) instead 
+        of reading and preparing the data file again.
+        Returns a SharedArrays object; its path goes to the workers, and its 
+        close() removes the published data when they are done. A worker that 
+        fits one order attaches with Data.attach(path, orders=[r]).
+        """
+        session = get_session()
+        def value(a):
+            return a if isinstance(a, np.ndarray) else session.run(a)
+        arrays = {attr: np.asarray(getattr(self, attr)) 
+                  for attr in ['pipeline_rvs', 'dates', 'bervs', 'drifts', 'airms', 'epoch_mask']}
+        for r in range(self.R):
+            arrays['ys_{0}'.format(r)] = value(self.ys[r])
+            arrays['ivars_{0}'.format(r)] = value(self.ivars[r])
+            if self.wavelength_coeffs[r] is None:
+                arrays['xs_{0}'.format(r)] = value(self.xs[r])
+            else:
+                arrays['wavelength_coeffs_{0}'.format(r)] = self.wavelength_coeffs[r]
+            if self.bad_pixels[r] is not None:
+                arrays['bad_pixels_{0}'.format(r)] = value(self.bad_pixels[r])
+        info = {'N': int(self.N), 'orders': [int(o) for o in self.orders], 'origin_file': self.origin_file, 
+                'min_flux': self.min_flux, 'dtype': self.T.name}
+        return SharedArrays.publish(arrays, info=info, path=path)
         
-        # convert to tensors
+    @classmethod
+    def attach(cls, path, orders=None, tensors=False, dtype=None, context=None):
+        """
+        Data published by Data.publish() in path, e.g. in a worker process. 
+        orders keyword (indices r into the published orders) attaches to only 
+        those orders, e.g. the one a worker fits; order_indices maps them back. 
+        By default the arrays are read-only memory maps of the published ones, so 
+        no copies are made (except for xs computed from wavelength solutions), and 
+        each order is copied into the session only when it is optimized (see 
+        to_tensors()). With tensors=True, all attached orders are copied at once.
+        dtype keyword defaults to the precision of the published data.
+        """
+        shared = SharedArrays.attach(path)
+        data = cls.__new__(cls)
+        data.shared = shared # keeps the memory maps open
+        data.context = context
+        data.T = tf.as_dtype(shared.info['dtype']) if dtype is None else dtype
+        data.N = shared.info['N']
+        if orders is None:
+            orders = range(len(shared.info['orders']))
+        data.order_indices = list(orders)
+        data.orders = [shared.info['orders'][r] for r in data.order_indices]
+        data.R = len(data.orders)
+        data.origin_file = shared.info['origin_file']
+        data.min_flux = shared.info['min_flux']
+        data.stream = False
+        for attr in ['pipeline_rvs', 'dates', 'bervs', 'drifts', 'airms']:
+            setattr(data, attr, shared[attr])
+        data.epoch_mask = list(shared['epoch_mask'])
+        data.compact_cache = {}
+        data.xs, data.ys, data.ivars, data.wavelength_coeffs, data.bad_pixels = [], [], [], [], []
+        for r in data.order_indices:
+            data.ys.append(shared['ys_{0}'.format(r)])
+            data.ivars.append(shared['ivars_{0}'.format(r)])
+            data.bad_pixels.append(shared['bad_pixels_{0}'.format(r)] if 'bad_pixels_{0}'.format(r) in shared else None)
+            if 'xs_{0}'.format(r) in shared:
+                data.wavelength_coeffs.append(None)
+                data.xs.append(shared['xs_{0}'.format(r)])
+            else:
+                coeffs = np.copy(shared['wavelength_coeffs_{0}'.format(r)])
+                data.wavelength_coeffs.append(coeffs)
+                data.xs.append(None if tensors else np.log(wavelength_solutions(coeffs, data.ys[-1].shape[1])))
         if tensors:
-            self.ys = [tf.constant(y, dtype=T) for y in self.ys]
-            self.xs = [tf.constant(x, dtype=T) for x in self.xs]
-            self.ivars = [tf.constant(i, dtype=T) for i in self.ivars]
+            data.to_tensors()
+        return data
         
     def continuum_normalize(self):
         for r in range(self.R):
             for n in range(self.N):
-                self.ys[r][n] -= fit_continuum(self.xs[r][n], self.ys[r][n], self.ivars[r][n])
+                self.ys[r][n] -= fit_continuum(self.xs[r][n], self.ys[r][n], 
+                                               np.broadcast_to(self.ivars[r][n], self.xs[r][n].shape))
+                                               
+    def pixel_ivars(self, r):
+        """
+        ivars of order r at every pixel (N x M), also if they are stored per epoch,
+        with zero weight at the bad pixels.
+        """
+        ivars = self.ivars[r] * tf.ones_like(self.ys[r])
+        bad = self.bad_pixels[r]
+        if bad is None or int(bad.shape[0]) == 0:
+            return ivars
+        is_bad = tf.scatter_nd(tf.reshape(bad, [-1, 1]), tf.ones_like(bad, dtype=self.T), 
+                               tf.reshape(tf.size(ivars, out_type=tf.int64), [1])) # each bad pixel is listed once
+        return ivars * (1. - tf.reshape(is_bad, tf.shape(ivars)))
+        
+    def compact_ivars(self, r, inds):
+        """
+        ivars of order r at the pixels inds (indices into the flattened (N x M) 
+        arrays), gathered from the ivars as they are stored, i.e. per epoch or per pixel.
+        """
+        N, M = [int(d) for d in self.ys[r].shape]
+        n_ivars, m_ivars = [int(d) for d in self.ivars[r].shape]
+        if m_ivars == 1 and M != 1: # per epoch
+            inds = inds // M
+        elif n_ivars == 1 and N != 1: # per column
+            inds = inds % M
+        return tf.gather(tf.reshape(self.ivars[r], [-1]), inds)
+                
+    @in_context
+    def get_compact(self, r):
+        """
+        Get the pixels of order r that enter the likelihood: those with nonzero ivars
+        in epochs allowed by the current epoch_mask.
+        Returns indices into the flattened (N x M) arrays plus the ys and ivars at those pixels.
+        The indices and ys are computed once per order and epoch mask and cached; the 
+        ivars are gathered from the stored ivars on the fly (see compact_ivars()).
+        """
+        epoch_mask = np.asarray(self.epoch_mask, dtype=bool)
+        key = (self.ys[r].name, epoch_mask.tobytes()) # the same for views of this order
+        if key not in self.compact_cache:
+            pixel_ivars = self.pixel_ivars(r)
+            mask = tf.logical_and(tf.greater(pixel_ivars, 0.), tf.constant(epoch_mask)[:, None])
+            mask = tf.reshape(mask, [-1])
+            session = get_session()
+            inds, ys = session.run([tf.where(mask)[:, 0], tf.boolean_mask(tf.reshape(self.ys[r], [-1]), mask)])
+            self.compact_cache[key] = (data_variable(inds, tf.int64, name='inds'), data_variable(ys, self.T, name='ys'))
+        inds, ys = self.compact_cache[key]
+        return inds, ys, self.compact_ivars(r, inds)
+        
+    @in_context
+    def nll(self, r, synth):
+        """
+        Negative log-likelihood of synthesized spectra synth (N x M) for order r.
+        """
+        inds, ys, ivars = self.get_compact(r)
+        synth = tf.gather(tf.reshape(synth, [-1]), inds)
+        return 0.5*reduce_sum64(tf.square(ys - synth) * ivars)
+        
+    def subset(self, orders=None, epochs=None):
+        """
+        View of the data restricted to some orders (indices r into this object's
+        orders) and/or epochs (indices into its epochs), without copying anything: 
+        the view shares the data arrays and tensors of its orders with this object. 
+        All N epochs stay in place, and the view masks out the others in its own 
+        epoch_mask (on top of the mask of this object), so that per-epoch arrays 
+        keep their indices. order_indices maps the view's orders back to this object.
+        """
+        view = copy.copy(self)
+        if orders is not None:
+            orders = list(orders)
+            view.R = len(orders)
+            view.orders = [self.orders[r] for r in orders]
+            view.order_indices = [self.order_indices[r] for r in orders]
+            for attr in ['xs', 'ys', 'ivars', 'wavelength_coeffs', 'bad_pixels']:
+                setattr(view, attr, [getattr(self, attr)[r] for r in orders])
+        view.epoch_mask = np.asarray(self.epoch_mask, dtype=bool)
+        if epochs is not None:
+            view.epoch_mask = view.epoch_mask & np.isin(np.arange(self.N), epochs)
+        return view
+        
+    @in_context
+    def chunk(self, r, columns, weights=None):
+        """
+        Shallow copy of the data in which order r is cut down to the pixel columns
+        columns[0]:columns[1], with the ivars multiplied by weights (one per column).
+        All other orders and attributes are shared with this object.
+        """
+        start, stop = columns
+        xs, ys, ivars = get_session().run([self.xs[r][:, start:stop], self.ys[r][:, start:stop], 
+                                           self.pixel_ivars(r)[:, start:stop]])
+        if weights is not None:
+            ivars = ivars * weights[None, :]
+        chunk = copy.copy(self)
+        chunk.xs, chunk.ys, chunk.ivars = list(self.xs), list(self.ys), list(self.ivars)
+        chunk.xs[r] = data_variable(xs, tf.float64, name='xs')
+        chunk.ys[r] = data_variable(ys, self.T, name='ys')
+        chunk.ivars[r] = data_variable(ivars, self.T, name='ivars')
+        chunk.bad_pixels = list(self.bad_pixels)
+        chunk.bad_pixels[r] = None # zeroed in the ivars
+        chunk.compact_cache = {}
+        return chunk
+        
+    @in_context
+    def coadd(self, max_dt=0.2, max_dberv=100.):
+        """
+        Co-added copy of the data, to learn templates from fewer epochs: in time 
+        order, exposures taken within max_dt days and max_dberv m/s of BERV of the 
+        first exposure of a group are resampled onto the wavelengths of that 
+        exposure and averaged with ivar weights, in every order. Masked epochs 
+        are left out. The dates, BERVs etc. of a composite are the means over its 
+        exposures, and groups holds the indices of the exposures in each one.
+        """
+        assert not self.stream, "coadd() needs the data in memory."
+        good = np.nonzero(np.asarray(self.epoch_mask, dtype=bool))[0]
+        good = good[np.argsort(self.dates[good], kind='mergesort')] # stable
+        groups = []
+        for n in good:
+            if len(groups) > 0 and self.dates[n] - self.dates[groups[-1][0]] <= max_dt \
+                    and abs(self.bervs[n] - self.bervs[groups[-1][0]]) <= max_dberv:
+                groups[-1].append(n)
+            else:
+                groups.append([n])
+        groups = [np.array(g) for g in groups]
+        session = get_session()
+        coadded = copy.copy(self)
+        coadded.N = len(groups)
+        coadded.groups = groups
+        for attr in ['pipeline_rvs', 'dates', 'bervs', 'drifts', 'airms']:
+            setattr(coadded, attr, np.array([np.mean(getattr(self, attr)[g]) for g in groups]))
+        coadded.epoch_mask = [True for g in groups]
+        coadded.xs, coadded.ys, coadded.ivars = [], [], []
+        coadded.wavelength_coeffs = [None for r in range(self.R)]
+        coadded.bad_pixels = [None for r in range(self.R)]
+        coadded.compact_cache = {}
+        for r in range(self.R):
+            tensors = not isinstance(self.ys[r], np.ndarray) # see to_tensors()
+            if tensors:
+                xs, ys, ivars = session.run([self.xs[r], self.ys[r], self.pixel_ivars(r)])
+            else:
+                xs, ys = np.asarray(self.xs[r]), np.asarray(self.ys[r])
+                ivars = expand_ivars(np.asarray(self.ivars[r]), self.bad_pixels[r], ys.shape)
+            sum_xs, sum_ys, sum_ivars = (np.zeros((len(groups), ys.shape[1])) for i in range(3))
+            for j,g in enumerate(groups):
+                sum_xs[j] = xs[g[0]]
+                for n in g:
+                    w = np.interp(sum_xs[j], xs[n], ivars[n], left=0., right=0.)
+                    w[np.interp(sum_xs[j], xs[n], (ivars[n] == 0.).astype(float)) > 0.] = 0. # next to a masked pixel
+                    sum_ys[j] += w * np.interp(sum_xs[j], xs[n], ys[n])
+                    sum_ivars[j] += w
+            sum_ys /= np.maximum(sum_ivars, 1.e-30)
+            if tensors:
+                coadded.xs.append(data_variable(sum_xs, tf.float64, name='xs'))
+                coadded.ys.append(data_variable(sum_ys, self.T, name='ys'))
+                coadded.ivars.append(data_variable(sum_ivars, self.T, name='ivars'))
+            else:
+                coadded.xs.append(sum_xs)
+                coadded.ys.append(sum_ys)
+                coadded.ivars.append(sum_ivars)
+        return coadded
+        
+    @in_context
+    def bin(self, r, factor):
+        """
+        Shallow copy of the data in which order r is binned down by factor in 
+        pixel columns: ys are ivar-weighted means, ivars are summed and xs are 
+        averaged over each group of factor columns (the last group may be smaller).
+        All other orders and attributes are shared with this object.
+        """
+        xs, ys, ivars = get_session().run([self.xs[r], self.ys[r], self.pixel_ivars(r)])
+        starts = np.arange(0, xs.shape[1], factor)
+        counts = np.diff(np.append(starts, xs.shape[1]))
+        binned_ivars = np.add.reduceat(ivars, starts, axis=1)
+        binned_ys = np.add.reduceat(ivars * ys, starts, axis=1) / np.maximum(binned_ivars, 1.e-30)
+        binned = copy.copy(self)
+        binned.xs, binned.ys, binned.ivars = list(self.xs), list(self.ys), list(self.ivars)
+        binned.xs[r] = data_variable(np.add.reduceat(xs, starts, axis=1) / counts, tf.float64, name='xs')
+        binned.ys[r] = data_variable(binned_ys, self.T, name='ys')
+        binned.ivars[r] = data_variable(binned_ivars, self.T, name='ivars')
+        binned.bad_pixels = list(self.bad_pixels)
+        binned.bad_pixels[r] = None # zeroed in the ivars
+        binned.compact_cache = {}
+        return binned
+        
+    @in_context
+    def batch(self, r):
+        """
+        Shallow copy of the data in which order r holds a batch of epochs that is 
+        fed in through placeholders for xs, ys and ivars (see streaming.EpochReader).
+        """
+        batch = copy.copy(self)
+        batch.xs, batch.ys, batch.ivars = list(self.xs), list(self.ys), list(self.ivars)
+        batch.xs[r] = tf.placeholder(tf.float64, shape=[None, None], name='xs_batch')
+        batch.ys[r] = tf.placeholder(self.T, shape=[None, None], name='ys_batch')
+        batch.ivars[r] = tf.placeholder(self.T, shape=[None, None], name='ivars_batch')
+        batch.bad_pixels = list(self.bad_pixels)
+        batch.bad_pixels[r] = None # zeroed in the ivars by EpochReader
+        batch.compact_cache = {}
+        return batch
         
                 
 class Model(object):
     """
     Keeps track of all components in the model.
+    The model lives in the Context of its data (if any): add_component() 
+    takes components made in that context.
     """
     def __init__(self, data):
         self.components = []
         self.component_names = []
         self.data = data
+        self.context = getattr(data, 'context', None)
+        self.rv_fitters = {} # cached graphs for optimize_rvs_order()
         
     def __str__(self):
         string = 'Model consisting of the following components: '
@@ -119,32 +499,83 @@ class Model(object):
             string += '{0} variable basis components'.format(c.K)
         return string
         
+    @in_context
     def synthesize(self, r):
-        synth = tf.zeros_like(self.data.xs[r])
+        synth = tf.zeros_like(self.data.ys[r])
         for c in self.components:
             synth += c.synthesize(r)
         return synth
         
-    def add_star(self, name, rvs_fixed=False, variable_bases=0):
+    @in_context
+    def add_star(self, name, rvs_fixed=False, variable_bases=0, library=None, instrument=None, target=None):
+        """
+        library keyword takes a TemplateLibrary to start the templates from, 
+        with the instrument and target (default: name) to look them up by.
+        """
         if np.isin(name, self.component_names):
             print("The model already has a component named {0}. Try something else!".format(name))
             return
         c = Star(name, self.data, rvs_fixed=rvs_fixed, variable_bases=variable_bases)
-        self.components.append(c)
-        self.component_names.append(name)
+        c.use_library(library, instrument, target=name if target is None else target)
+        self.add_component(c)
         
-    def add_telluric(self, name, rvs_fixed=True, variable_bases=0):
+    @in_context
+    def add_telluric(self, name, rvs_fixed=True, variable_bases=0, library=None, instrument=None):
+        """
+        library keyword takes a TemplateLibrary to start the templates from,
+        with the instrument to look them up by.
+        """
         if np.isin(name, self.component_names):
             print("The model already has a component named {0}. Try something else!".format(name))
             return
         c = Telluric(name, self.data, rvs_fixed=rvs_fixed, variable_bases=variable_bases)
+        c.use_library(library, instrument)
+        self.add_component(c)
+        
+    @in_context
+    def add_component(self, c):
+        get_session().run(tf.variables_initializer(c.get_variables()))
         self.components.append(c)
-        self.component_names.append(name)
-                                
+        self.component_names.append(c.name)
+        
+    @in_context
+    def initialize_templates(self, data, orders=None):
+        """
+        Initialize the templates of all components, for all of the given orders at once.
+        orders keyword defaults to all orders without a template.
+        """
+        if orders is None:
+            orders = [r for r in range(data.R) if not all(c.template_exists[r] for c in self.components)]
+        if len(orders) == 0:
+            return
+        data.to_tensors(orders=orders)
+        for c in self.components: # start from scratch, as in a new model
+            for r in orders:
+                c.template_exists[r] = False
+        for c in self.components:
+            c.initialize_templates(orders, data, other_components=[x for x in self.components if x!=c])
+
+    @in_context
+    def load_templates(self, results):
+        """
+        Fix the templates, basis vectors and regularization amplitudes of all
+        components to the values learned in a previous run (a Results object).
+        Components are matched by name and orders by their index in the original data.
+        """
+        result_orders = list(results.orders)
+        for c in self.components:
+            assert c.name in results.component_names, "ERROR: component {0} not found in results.".format(c.name)
+            for r,o in enumerate(self.data.orders):
+                assert o in result_orders, "ERROR: order {0} not found in results.".format(o)
+                c.load_template(r, results, result_orders.index(o))
+        self.rv_fitters = {} # built on the variables that were just replaced
+
 class Component(object):
     """
     Generic class for an additive component in the spectral model.
     """
+    kind = None # key for templates in a TemplateLibrary
+    
     def __init__(self, name, data, rvs_fixed=False, variable_bases=0, regularization_file='regularization/default.pkl'):
         self.data = data
         self.name = name
@@ -155,14 +586,34 @@ class Component(object):
         self.time_rvs = np.zeros(data.N) # will be replaced in combine_orders()
         self.order_rvs = np.zeros(data.R) # will be replaced in combine_orders()
         self.order_sigmas = np.ones(data.R) # will be replaced in combine_orders()
-        self.template_xs = [tf.constant(0., dtype=T) for r in range(data.R)] # this will be replaced
-        self.template_ys = [tf.constant(0., dtype=T) for r in range(data.R)] # this will be replaced
-        self.basis_vectors = [tf.constant(0., dtype=T) for r in range(data.R)] # this will be replaced
-        self.basis_weights = [tf.constant(0., dtype=T) for r in range(data.R)] # this will be replaced
+        # variables of any shape, filled by initialize_templates():
+        self.template_xs = [tf.Variable(np.zeros(0), dtype=T, validate_shape=False, 
+                                        name='template_xs') for r in range(data.R)]
+        self.template_ys = [tf.Variable(np.zeros(0), dtype=data.T, validate_shape=False, 
+                                        name='template_ys') for r in range(data.R)]
+        if self.K > 0:
+            self.basis_vectors = [tf.Variable(np.zeros((self.K, 0)), dtype=data.T, validate_shape=False, 
+                                              name='basis_vectors') for r in range(data.R)]
+            self.basis_weights = [tf.Variable(np.zeros((data.N, self.K)), dtype=data.T, validate_shape=False, 
+                                              name='basis_weights') for r in range(data.R)]
+        else:
+            self.basis_vectors = [tf.constant(0., dtype=data.T) for r in range(data.R)] # not used
+            self.basis_weights = [tf.constant(0., dtype=data.T) for r in range(data.R)] # not used
+        self.assign_ops = {} # (placeholder, assign op) for each variable
         self.template_exists = [False for r in range(data.R)] # if True, skip initialization
+        self.template_uniform = [False for r in range(data.R)] # if True, template_xs are evenly spaced
+        self.compiled = False # if True, build graphs that XLA can compile
         self.learning_rate_rvs = 10. # default
         self.learning_rate_template = 0.01 # default
         self.learning_rate_basis = 0.01 # default
+        self.svd_method = 'full' # or 'randomized', for basis vector initialization
+        self.svd_oversample = 10 # for svd_method = 'randomized'
+        self.svd_n_iter = 2 # for svd_method = 'randomized'
+        self.template_resolution = None # if set, space template nodes by resolution element
+        self.template_oversample = 3. # template nodes per resolution element
+        self.template_trim = False # if True, drop template nodes far from any data
+        self.template_coarse_tol = None # if set, use fewer nodes in featureless regions
+        self.library = None # if set, a TemplateLibrary to initialize templates from
         try: # load pickle
             reg_amps = pickle.load(open(regularization_file, 'rb'))
             self.L1_template = [reg_amps.L1_template[r] for r in data.orders]
@@ -181,62 +632,332 @@ class Component(object):
             self.L2_basis_vectors = [0. for r in range(data.R)]
             self.L2_basis_weights = [1. for r in range(data.R)]
         
-    def shift_and_interp(self, r, rvs):
+    def shift_and_interp(self, r, rvs, return_slope=False):
         """
         Apply Doppler shift of rvs to the model at order r and output interpolated values at data xs.
+        The shift is done in float64; at lower precision, the interpolation is done 
+        relative to the start of the template to preserve wavelength resolution.
+        return_slope keyword also outputs the template slope at the shifted xs.
         """
         shifted_xs = self.data.xs[r] + tf.log(doppler(rvs[:, None]))
-        return interp(shifted_xs, self.template_xs[r], self.template_ys[r]) 
+        template_xs = self.template_xs[r]
+        if self.data.T != tf.float64:
+            shifted_xs = tf.cast(shifted_xs - template_xs[0], self.data.T)
+            template_xs = tf.cast(template_xs - template_xs[0], self.data.T)
+        uniform = self.compiled and self.template_uniform[r]
+        synth, slope = interp_with_slope(shifted_xs, template_xs, self.template_ys[r], uniform=uniform)
+        if return_slope:
+            return synth, slope
+        return synth
         
-    def synthesize(self, r):
+    def synthesize(self, r, rvs=None):
         """
         Output synthesized spectrum for order r.
+        rvs keyword overrides the current RVs of the component.
         """
+        if rvs is None:
+            rvs = self.rvs_block[r]
         if self.template_exists[r]:
-            synth = self.shift_and_interp(r, self.rvs_block[r])
+            synth = self.shift_and_interp(r, rvs)
             if self.K > 0:
                 synth += tf.matmul(self.basis_weights[r], self.basis_vectors[r])
         else:
-            synth = tf.zeros_like(self.data.xs[r])
+            synth = tf.zeros_like(self.data.ys[r])
         return synth
         
+    def rv_jacobian(self, r):
+        """
+        Derivative of the synthesized spectrum for order r with respect to each epoch's RV,
+        using the analytic slope of the interpolated template.
+        """
+        rvs = self.rvs_block[r]
+        _, slope = self.shift_and_interp(r, rvs, return_slope=True)
+        return slope * tf.cast(dlogdoppler_dv(rvs), self.data.T)[:, None]
+        
+    def make_newton_rvs(self, r, other_components, step_fractions=[1., 0.5, 0.25, 0.125]):
+        """
+        Set up a batched Gauss-Newton update of the RVs for order r, with all other 
+        parameters held fixed. Each epoch's RV only affects its own row of the 
+        likelihood, so every epoch takes its own step. The step is safeguarded by 
+        a line search: all trial fractions of the step are evaluated at once and 
+        each epoch keeps the one with the lowest chi-squared (or no step at all).
+        """
+        data = self.data
+        rvs = self.rvs_block[r]
+        rest = tf.zeros_like(data.ys[r])
+        for c in other_components:
+            rest += c.synthesize(r)
+        resids = data.ys[r] - rest - self.synthesize(r)
+        J = self.rv_jacobian(r)
+        ivars = data.pixel_ivars(r)
+        grad = reduce_sum64(ivars * resids * J, axis=1) # = -d(nll)/d(rvs)
+        hess = reduce_sum64(ivars * tf.square(J), axis=1)
+        ok = tf.greater(hess, tf.zeros_like(hess))
+        step = tf.where(ok, grad / tf.where(ok, hess, tf.ones_like(hess)), tf.zeros_like(grad))
+        fractions = [0.] + list(step_fractions)
+        chisqs = []
+        for f in fractions:
+            trial = rest + self.synthesize(r, rvs=rvs + f * step)
+            chisqs.append(reduce_sum64(ivars * tf.square(data.ys[r] - trial), axis=1))
+        best = tf.argmin(tf.stack(chisqs), axis=0)
+        self.step_rvs_newton = tf.gather(tf.constant(fractions, dtype=T), best) * step
+        self.opt_rvs_newton = tf.assign_add(rvs, self.step_rvs_newton)
+        
+    def get_variables(self):
+        variables = self.rvs_block + self.template_xs + self.template_ys
+        if self.K > 0:
+            variables += self.basis_vectors + self.basis_weights
+        return variables
+        
+    def assign(self, values):
+        """
+        Set variables to new values (of any shape) in a single session call.
+        values is a dictionary of numpy arrays keyed by variable.
+        """
+        ops, feed_dict = [], {}
+        for var, value in values.items():
+            if var not in self.assign_ops:
+                placeholder = tf.placeholder(var.dtype.base_dtype)
+                self.assign_ops[var] = (placeholder, tf.assign(var, placeholder, validate_shape=False))
+            placeholder, op = self.assign_ops[var]
+            ops.append(op)
+            feed_dict[placeholder] = value
+        get_session().run(ops, feed_dict=feed_dict)
+        
     def initialize_template(self, r, data, other_components=None, template_xs=None):
         """
         Doppler-shift data into component rest frame, subtract off other components, 
         and average to make a composite spectrum.
         """
-        shifted_xs = data.xs[r] + tf.log(doppler(self.rvs_block[r][:, None])) # component rest frame
+        if template_xs is not None:
+            template_xs = [template_xs]
+        self.initialize_templates([r], data, other_components=other_components, template_xs=template_xs)
+        
+    def initialize_templates(self, orders, data, other_components=None, template_xs=None):
+        """
+        Same as initialize_template() for several orders at once: the data and 
+        other components are fetched in one session call, the templates are binned 
+        for all orders together and the results are assigned in one more call.
+        The RVs of the component are reset to their starting values.
+        template_xs keyword is a list with a grid for each order; by default 
+        the grids are made by utils.template_grid() with the template_* 
+        attributes of the component.
+        """
+        if other_components is None:
+            other_components = []
+        adaptive = self.template_trim or self.template_coarse_tol is not None
+        session = get_session()
+        session.run([self.rvs_block[r].initializer for r in orders])
+        fetches = []
+        for r in orders:
+            resids = 1. * data.ys[r]
+            for c in other_components: # subtract off initialized components
+                if c.template_exists[r]:
+                    resids -= c.shift_and_interp(r, c.rvs_block[r])
+            fetches.append((data.xs[r], resids, self.rvs_block[r], data.pixel_ivars(r) if adaptive else []))
+        xs, resids, rvs, ivars = zip(*session.run(fetches))
+        self.templates_from_residuals(orders, xs, resids, rvs, ivars, template_xs=template_xs)
+        
+    def templates_from_residuals(self, orders, xs, resids, rvs, ivars, template_xs=None, epochs=None):
+        """
+        Make and assign the templates (and basis vectors) for orders from numpy 
+        arrays, one per order, of the data xs, the data minus all other components, 
+        the RVs of this component and the ivars (only used for adaptive grids).
+        epochs keyword gives the epoch indices of the rows if they are not all 
+        epochs; the basis weights of the other epochs are set to zero.
+        """
+        adaptive = self.template_trim or self.template_coarse_tol is not None
+        shifted_xs = [x + np.log(doppler_np(v))[:, None] for x,v in zip(xs, rvs)] # component rest frame
         if template_xs is None:
-            dx = tf.constant(2.*(np.log(6000.01) - np.log(6000.)), dtype=T) # log-uniform spacing
-            tiny = tf.constant(10., dtype=T)
-            template_xs = tf.range(tf.reduce_min(shifted_xs)-tiny*dx, 
-                                   tf.reduce_max(shifted_xs)+tiny*dx, dx)           
-        resids = 1. * data.ys[r]
-        for c in other_components: # subtract off initialized components
-            if c.template_exists[r]:
-                resids -= c.shift_and_interp(r, c.rvs_block[r])
-                
+            template_xs = [template_grid(x, ivars=iv if adaptive else None, ys=y, 
+                                         resolution=self.template_resolution, 
+                                         oversample=self.template_oversample, trim=self.template_trim, 
+                                         coarse_tol=self.template_coarse_tol) 
+                           for x,y,iv in zip(shifted_xs, resids, ivars)]
+        template_ys = bin_data_orders(shifted_xs, resids, template_xs)
+        library_basis = [None for r in orders]
+        if self.library is not None: # warm start wherever a stored template covers the grid
+            for i,r in enumerate(orders):
+                template_ys[i], library_basis[i] = self.template_from_library(r, template_xs[i], template_ys[i], 
+                                                                              np.mean(xs[i], axis=0))
+        
+        values = {}
+        for i,r in enumerate(orders):
+            values[self.template_xs[r]] = template_xs[i]
+            values[self.template_ys[r]] = template_ys[i]
+            if self.K > 0:
+                # initialize basis components
+                basis_resids = resids[i] - np.interp(shifted_xs[i], template_xs[i], template_ys[i])
+                if library_basis[i] is not None: # fit weights to the stored basis vectors
+                    v = library_basis[i]
+                    weights = np.linalg.lstsq(v.T, basis_resids.T, rcond=None)[0].T
+                else:
+                    if self.svd_method == 'randomized': # only compute the K vectors we need
+                        u,s,v = randomized_svd(basis_resids, self.K, oversample=self.svd_oversample, n_iter=self.svd_n_iter)
+                    else:
+                        u,s,v = np.linalg.svd(basis_resids, full_matrices=False)
+                    weights = (u * s)[:,:self.K] # weights (N x K)
+                values[self.basis_vectors[r]] = v[:self.K,:] # eigenspectra (K x M)
+                if epochs is not None:
+                    all_weights = np.zeros((self.data.N, self.K))
+                    all_weights[epochs] = weights
+                    weights = all_weights
+                values[self.basis_weights[r]] = weights
+        self.assign(values)
+        for i,r in enumerate(orders):
+            steps = np.diff(template_xs[i])
+            self.template_uniform[r] = bool(np.allclose(steps, steps[0], rtol=1.e-6, atol=0.))
+            self.template_exists[r] = True
+
+    def chunk(self, r, data, nodes, columns):
+        """
+        Shallow copy of the component that models a chunk of order r (data 
+        from Data.chunk()), with new variables for the template nodes 
+        nodes[0]:nodes[1] and for the basis vectors on the pixel columns 
+        columns[0]:columns[1], starting from the current values. 
+        The RVs and basis weights are shared with this component.
+        The new variables still need to be initialized.
+        """
         session = get_session()
-        session.run(tf.global_variables_initializer())
-        template_xs, template_ys = bin_data(session.run(shifted_xs), session.run(resids), 
-                                            session.run(template_xs)) # hack
-        self.template_xs[r] = tf.Variable(template_xs, dtype=T, name='template_xs')
-        self.template_ys[r] = tf.Variable(template_ys, dtype=T, name='template_ys') 
+        template_xs, template_ys = session.run([self.template_xs[r], self.template_ys[r]])
+        chunk = copy.copy(self)
+        chunk.data = data
+        chunk.template_xs, chunk.template_ys = list(self.template_xs), list(self.template_ys)
+        chunk.template_xs[r] = data_variable(template_xs[nodes[0]:nodes[1]], T, name='template_xs')
+        chunk.template_ys[r] = tf.Variable(template_ys[nodes[0]:nodes[1]], dtype=data.T, name='template_ys_chunk')
         if self.K > 0:
-            # initialize basis components
-            resids -= self.shift_and_interp(r, self.rvs_block[r])
-            s,u,v = tf.svd(resids, compute_uv=True)
-            basis_vectors = tf.transpose(tf.conj(v[:,:self.K])) # eigenspectra (K x M)
-            basis_weights = (u * s)[:,:self.K] # weights (N x K)
-            self.basis_vectors[r] = tf.Variable(basis_vectors, dtype=T, name='basis_vectors')
-            self.basis_weights[r] = tf.Variable(basis_weights, dtype=T, name='basis_weights') 
-            session.run(tf.variables_initializer([self.basis_vectors[r], self.basis_weights[r]]))  # TODO: more elegant way to do this?
-        session.run(tf.variables_initializer([self.template_xs[r], self.template_ys[r]]))  # TODO: more elegant way to do this?
-        self.template_exists[r] = True
-         
+            basis_vectors = session.run(self.basis_vectors[r])
+            chunk.basis_vectors = list(self.basis_vectors)
+            chunk.basis_vectors[r] = tf.Variable(basis_vectors[:, columns[0]:columns[1]], dtype=data.T, 
+                                                 name='basis_vectors_chunk')
+        return chunk
+
+    def coarse(self, r, data, factor):
+        """
+        Shallow copy of the component that models order r of binned data (from 
+        Data.bin()) with every factor-th template node and the basis vectors 
+        averaged over groups of factor columns, in new variables that start 
+        from the current values (which are kept, for refine()). The RVs and 
+        basis weights are shared with this component. The new variables still 
+        need to be initialized.
+        """
+        session = get_session()
+        template_xs, template_ys = session.run([self.template_xs[r], self.template_ys[r]])
+        nodes = np.unique(np.append(np.arange(0, len(template_xs), factor), len(template_xs) - 1)) # keep both ends
+        coarse = copy.copy(self)
+        coarse.data = data
+        coarse.template_xs, coarse.template_ys = list(self.template_xs), list(self.template_ys)
+        coarse.template_xs[r] = data_variable(template_xs[nodes], T, name='template_xs')
+        coarse.template_ys[r] = tf.Variable(template_ys[nodes], dtype=data.T, name='template_ys_coarse')
+        coarse.initial_template_ys = template_ys[nodes]
+        coarse.template_uniform = list(self.template_uniform)
+        coarse.template_uniform[r] = False
+        if self.K > 0:
+            basis_vectors = session.run(self.basis_vectors[r])
+            starts = np.arange(0, basis_vectors.shape[1], factor)
+            counts = np.diff(np.append(starts, basis_vectors.shape[1]))
+            coarse.basis_vectors = list(self.basis_vectors)
+            coarse.initial_basis_vectors = np.add.reduceat(basis_vectors, starts, axis=1) / counts
+            coarse.basis_vectors[r] = tf.Variable(coarse.initial_basis_vectors, dtype=data.T, 
+                                                  name='basis_vectors_coarse')
+        return coarse
+        
+    def refine(self, r, coarse, factor):
+        """
+        Add what coarse (from self.coarse()) learned for order r, i.e. the change 
+        of its template and basis vectors since it was made, upsampled onto the 
+        full grid of this component. Detail finer than the coarse grid is kept.
+        """
+        session = get_session()
+        template_xs, template_ys, coarse_xs, coarse_ys = session.run([self.template_xs[r], self.template_ys[r], 
+                                                                      coarse.template_xs[r], coarse.template_ys[r]])
+        change = coarse_ys - coarse.initial_template_ys
+        values = {self.template_ys[r]: template_ys + np.interp(template_xs, coarse_xs, change)}
+        if self.K > 0:
+            basis_vectors, coarse_vectors = session.run([self.basis_vectors[r], coarse.basis_vectors[r]])
+            change = np.repeat(coarse_vectors - coarse.initial_basis_vectors, factor, axis=1)
+            values[self.basis_vectors[r]] = basis_vectors + change[:, :basis_vectors.shape[1]]
+        self.assign(values)
+
+    def rv_zero(self):
+        """
+        Zero point of the RVs, i.e. the RV at which the template frame is the data frame.
+        """
+        return 0.
+        
+    def use_library(self, library, instrument, target=''):
+        """
+        Initialize templates from library (a TemplateLibrary or None), using the 
+        templates stored for instrument (and target, for stars).
+        """
+        self.library = library
+        self.library_instrument = instrument
+        self.library_target = target
+        
+    def template_from_library(self, r, template_xs, template_ys, pixel_xs):
+        """
+        Replace template_ys on template_xs for order r by the stored template from 
+        self.library where there is one, and get its basis vectors on the pixel 
+        log-wavelengths pixel_xs if it has at least self.K of them (else None).
+        """
+        target = self.library_target if self.kind == 'star' else ''
+        shift = np.log(doppler_np(self.rv_zero()))
+        entry = self.library.find(self.library_instrument, self.kind, target=target, order=self.data.orders[r],
+                                  coverage=(template_xs[0] + shift, template_xs[-1] + shift))
+        if entry is None:
+            return template_ys, None
+        basis_xs = pixel_xs if 0 < self.K <= entry['K'] else None
+        stored_ys, basis_vectors, covered = self.library.resample(entry, template_xs, rv_zero=self.rv_zero(), 
+                                                                  basis_xs=basis_xs)
+        if basis_vectors is not None:
+            basis_vectors = basis_vectors[:self.K]
+        return np.where(covered, stored_ys, template_ys), basis_vectors
         
+    def batch(self, r, data, epochs):
+        """
+        Shallow copy of the component that models a batch of epochs of order r 
+        (data from Data.batch()), given a tensor of their indices. The RVs and 
+        basis weights of those epochs are gathered from the full variables, 
+        so their gradients only touch the rows in the batch.
+        """
+        batch = copy.copy(self)
+        batch.data = data
+        batch.rvs_block = list(self.rvs_block)
+        batch.rvs_block[r] = tf.gather(self.rvs_block[r], epochs)
+        if self.K > 0:
+            batch.basis_weights = list(self.basis_weights)
+            batch.basis_weights[r] = tf.gather(self.basis_weights[r], epochs)
+        return batch
+
+    def load_template(self, r, results, r_results):
+        """
+        Set the template for order r from order r_results of a Results object.
+        The template and basis vectors are held fixed; only the basis weights
+        are new variables, sized to the epochs in self.data.
+        """
+        basename = self.name+'_'
+        self.K = int(getattr(results, basename+'K'))
+        self.template_xs[r] = data_variable(getattr(results, basename+'template_xs')[r_results], T, name='template_xs')
+        self.template_ys[r] = data_variable(getattr(results, basename+'template_ys')[r_results], self.data.T, 
+                                            name='template_ys')
+        if self.K > 0:
+            self.basis_vectors[r] = data_variable(getattr(results, basename+'basis_vectors')[r_results], self.data.T, 
+                                                  name='basis_vectors')
+            self.basis_weights[r] = tf.Variable(np.zeros((self.data.N, self.K)), dtype=self.data.T, name='basis_weights')
+        for attr in ['L1_template', 'L2_template', 'L1_basis_vectors', 'L2_basis_vectors', 'L2_basis_weights']:
+            getattr(self, attr)[r] = getattr(results, basename+attr)[r_results]
+        self.template_exists[r] = True
+
+
     def make_optimizers(self, r, nll, learning_rate_rvs=None, 
-            learning_rate_template=None, learning_rate_basis=None):
+            learning_rate_template=None, learning_rate_basis=None, sparse=False, shared=True):
+        """
+        Adam optimizers for the parameters of order r, kept in self.updates as 
+        (optimizer, grads_and_vars) for group_updates() and as opt_* ops that 
+        apply them one at a time. With sparse, the RVs and basis weights take lazy 
+        Adam steps that leave epochs without gradients alone (see batch()); 
+        shared=False leaves them out, for chunks that share them (see chunk()).
+        """
         # TODO: make each one an R-length list rather than overwriting each order?
         if learning_rate_rvs == None:
             learning_rate_rvs = self.learning_rate_rvs
@@ -244,29 +965,34 @@ class Component(object):
             learning_rate_template = self.learning_rate_template
         if learning_rate_basis == None:
             learning_rate_basis = self.learning_rate_basis
-        self.gradients_template = tf.gradients(nll, self.template_ys[r])
-        self.opt_template = tf.train.AdamOptimizer(learning_rate_template).minimize(nll, 
-                            var_list=[self.template_ys[r]])
-        if not self.rvs_fixed:
-            self.gradients_rvs = tf.gradients(nll, self.rvs_block[r])
-            self.opt_rvs = tf.train.AdamOptimizer(learning_rate_rvs).minimize(nll, 
-                            var_list=[self.rvs_block[r]])
+        self.updates = {}
+        def update(name, var, learning_rate, lazy=False):
+            optimizer = (tf.contrib.opt.LazyAdamOptimizer if lazy else tf.train.AdamOptimizer)(learning_rate)
+            self.updates[name] = (optimizer, list(zip(tf.gradients(nll, var), [var])))
+            return optimizer.apply_gradients(self.updates[name][1])
+        self.opt_template = update('template', self.template_ys[r], learning_rate_template)
+        if shared and not self.rvs_fixed:
+            self.opt_rvs = update('rvs', self.rvs_block[r], learning_rate_rvs, lazy=sparse)
         if self.K > 0:
-            self.gradients_basis = tf.gradients(nll, [self.basis_vectors[r], self.basis_weights[r]])
-            self.opt_basis = tf.train.AdamOptimizer(learning_rate_basis).minimize(nll, 
-                            var_list=[self.basis_vectors[r], self.basis_weights[r]]) 
+            ops = [update('basis_vectors', self.basis_vectors[r], learning_rate_basis)]
+            if shared:
+                ops.append(update('basis_weights', self.basis_weights[r], learning_rate_basis, lazy=sparse))
+            self.opt_basis = tf.group(*ops)
+        self.optimizer_variables = [v for o,_ in self.updates.values() for v in o.variables()]
                               
     def combine_orders(self):
+        from scipy.optimize import minimize
+        session = get_session()
         self.all_rvs = np.asarray(session.run(self.rvs_block))
         self.all_ivars = np.asarray(session.run(self.ivars_block))
         # initial guess
         x0_order_rvs = np.median(self.all_rvs, axis=1)
-        x0_time_rvs = np.median(self.all_rvs - np.tile(x0_order_rvs[:,None], (1, self.N)), axis=0)
+        x0_time_rvs = np.median(self.all_rvs - np.tile(x0_order_rvs[:,None], (1, self.data.N)), axis=0)
         rv_predictions = np.tile(x0_order_rvs[:,None], (1,self.data.N)) + np.tile(x0_time_rvs, (self.data.R,1))
         x0_sigmas = np.log(np.var(self.all_rvs - rv_predictions, axis=1))
         self.M = None
         # optimize
-        soln_sigmas = minimize(self.opposite_lnlike_sigmas, x0_sigmas, args=(restart), method='BFGS', options={'disp':True})['x'] # HACK
+        soln_sigmas = minimize(self.opposite_lnlike_sigmas, x0_sigmas, method='BFGS', options={'disp':True})['x'] # HACK
         # save results
         lnlike, rvs_N, rvs_R = self.lnlike_sigmas(soln_sigmas, return_rvs=True)
         self.time_rvs = rvs_N
@@ -326,24 +1052,45 @@ class Star(Component):
     """
     A star (or generic celestial object)
     """
+    kind = 'star'
+    
     def __init__(self, name, data, rvs_fixed=False, variable_bases=0, regularization_file='regularization/default.pkl'):
         Component.__init__(self, name, data, rvs_fixed=rvs_fixed, variable_bases=variable_bases, regularization_file=regularization_file)
         starting_rvs = np.copy(data.bervs) - np.mean(data.bervs)
-        self.rvs_block = [tf.Variable(starting_rvs, dtype=T, name='rvs_order{0}'.format(r)) for r in range(data.R)] 
-                            
+        self.rvs_block = [tf.Variable(starting_rvs, dtype=T, name='rvs_order{0}'.format(r)) for r in range(data.R)]
+        
+    def rv_zero(self):
+        return np.mean(self.data.bervs)
+
+    def load_template(self, r, results, r_results):
+        Component.load_template(self, r, results, r_results)
+        # starting guesses must be in the rest frame of the stored template:
+        starting_rvs = np.copy(self.data.bervs) - np.mean(results.bervs)
+        self.rvs_block[r] = tf.Variable(starting_rvs, dtype=T, name='rvs_order{0}'.format(r))
+
 class Telluric(Component):
     """
     Sky absorption
     """
+    kind = 'telluric'
+    
     def __init__(self, name, data, rvs_fixed=True, variable_bases=0, regularization_file='regularization/default.pkl'):
         Component.__init__(self, name, data, rvs_fixed=rvs_fixed, variable_bases=variable_bases, regularization_file=regularization_file)
-        self.airms = tf.constant(data.airms, dtype=T)
+        self.airms = tf.constant(data.airms, dtype=data.T)
         self.learning_rate_template = 0.1
         
-    def synthesize(self, r):
-        synth = Component.synthesize(self, r)
+    def synthesize(self, r, rvs=None):
+        synth = Component.synthesize(self, r, rvs=rvs)
         return tf.einsum('n,nm->nm', self.airms, synth)
         
+    def rv_jacobian(self, r):
+        return self.airms[:, None] * Component.rv_jacobian(self, r)
+        
+    def batch(self, r, data, epochs):
+        batch = Component.batch(self, r, data, epochs)
+        batch.airms = tf.gather(self.airms, epochs)
+        return batch
+        
 class History(object):
     """
     Information about optimization history of a single order stored in numpy arrays/lists
@@ -353,7 +1100,9 @@ class History(object):
             assert c.template_exists[r], "ERROR: Cannot initialize History() until templates are initialized."
         self.nll_history = np.empty(niter)
         self.rvs_history = [np.empty((niter, data.N)) for c in model.components]
-        self.template_history = [np.empty((niter, int(c.template_ys[r].shape[0]))) for c in model.components]
+        with scope(model.context):
+            session = get_session()
+            self.template_history = [np.empty((niter, len(session.run(c.template_ys[r])))) for c in model.components]
         self.basis_vectors_history = [np.empty((niter, c.K, 4096)) for c in model.components] # HACK
         self.basis_weights_history = [np.empty((niter, data.N, c.K)) for c in model.components]
         self.chis_history = np.empty((niter, data.N, 4096)) # HACK
@@ -378,19 +1127,23 @@ class History(object):
                 self.basis_vectors_history[j][i,:,:] = np.copy(session.run(c.basis_vectors[self.r])) 
                 self.basis_weights_history[j][i,:,:] = np.copy(session.run(c.basis_weights[self.r]))
         
-    def write(self, filename=None):
+    def write(self, filename=None, writer=None):
         """
-        Write to hdf5
+        Write to hdf5 (atomically)
+        writer keyword takes a BackgroundWriter to write a snapshot of the 
+        history so far in the background instead
         """
         if filename is None:
             filename = 'order{0}_history.hdf5'.format(self.r)
         print("saving optimization history to {0}".format(filename))
-        with h5py.File(filename,'w') as f:
-            for attr in ['nll_history', 'chis_history', 'r', 'niter']:
-                f.create_dataset(attr, data=getattr(self, attr))
-            for attr in ['rvs_history', 'template_history', 'basis_vectors_history', 'basis_weights_history']:
-                for i in range(len(self.template_history)):
-                    f.create_dataset(attr+'_{0}'.format(i), data=getattr(self, attr)[i])   
+        values = {attr: getattr(self, attr) for attr in ['nll_history', 'chis_history', 'r', 'niter']}
+        for attr in ['rvs_history', 'template_history', 'basis_vectors_history', 'basis_weights_history']:
+            for i in range(len(self.template_history)):
+                values[attr+'_{0}'.format(i)] = getattr(self, attr)[i]
+        if writer is None:
+            write_atomic(filename, write_history, values)
+        else:
+            writer.submit(filename, write_history, {k: np.copy(v) for k,v in values.items()})
                     
     
     def read(self, filename):
@@ -407,41 +1160,19 @@ class History(object):
                 setattr(self, attr, d)
                 
         
-    def animfunc(self, i, xs, ys, xlims, ylims, ax, driver):
-        """
-        Produces each frame; called by History.plot()
-        """
-        ax.cla()
-        ax.set_xlim(xlims)
-        ax.set_ylim(ylims)
-        ax.set_title('Optimization step #{0}'.format(i))
-        s = driver(xs, ys[i,:])
-        
-    def plot(self, xs, ys, linestyle, nframes=None, ylims=None):
+    def plot(self, xs, ys, linestyle, nframes=None, ylims=None, filename=None, **kwargs):
         """
         Generate a matplotlib animation of xs and ys
         Linestyle options: 'scatter', 'line'
+        filename keyword renders the animation straight into a video file in parallel
+        processes instead (see plotting.render for the other keywords) and returns filename
         """
+        from .plotting import animate, render
         if nframes is None:
             nframes = self.niter
-        fig = plt.figure()
-        ax = plt.subplot() 
-        if linestyle == 'scatter':
-            driver = ax.scatter
-        elif linestyle == 'line':
-            driver = ax.plot
-        else:
-            print("linestyle not recognized.")
-            return
-        x_pad = (np.max(xs) - np.min(xs)) * 0.1
-        xlims = (np.min(xs)-x_pad, np.max(xs)+x_pad)
-        if ylims is None:
-            y_pad = (np.max(ys) - np.min(ys)) * 0.1
-            ylims = (np.min(ys)-y_pad, np.max(ys)+y_pad)
-        ani = animation.FuncAnimation(fig, self.animfunc, np.linspace(0, self.niter-1, nframes, dtype=int), 
-                    fargs=(xs, ys, xlims, ylims, ax, driver), interval=150)
-        plt.close(fig)
-        return ani  
+        if filename is not None:
+            return render(xs, ys, linestyle, filename, nframes=nframes, ylims=ylims, **kwargs)
+        return animate(xs, ys, linestyle, nframes=nframes, ylims=ylims, **kwargs)
                          
     def plot_rvs(self, ind, model, data, compare_to_pipeline=True, **kwargs):
         """
@@ -452,7 +1183,7 @@ class History(object):
         xs = data.dates
         ys = self.rvs_history[ind]
         if compare_to_pipeline:
-            ys -= np.repeat([data.pipeline_rvs], self.niter, axis=0)    
+            ys = ys - data.pipeline_rvs[None,:] # a copy: the history is not modified
         return self.plot(xs, ys, 'scatter', **kwargs)     
     
     def plot_template(self, ind, model, data, **kwargs):
@@ -460,8 +1191,8 @@ class History(object):
         Generate a matplotlib animation of the template inferred from data
         ind: index of component in model to be plotted
         """
-        session = get_session()
-        template_xs = session.run(model.components[ind].template_xs[self.r])
+        with scope(model.context):
+            template_xs = get_session().run(model.components[ind].template_xs[self.r])
         xs = np.exp(template_xs)
         ys = np.exp(self.template_history[ind])
         return self.plot(xs, ys, 'line', **kwargs) 
@@ -471,166 +1202,624 @@ class History(object):
         Generate a matplotlib animation of model chis in data space
         epoch: index of epoch to plot
         """
-        session = get_session()
-        data_xs = session.run(data.xs[self.r][epoch,:])
+        with scope(data.context):
+            data_xs = get_session().run(data.xs[self.r][epoch,:])
         xs = np.exp(data_xs)
         ys = self.chis_history[:,epoch,:]
         return self.plot(xs, ys, 'line', **kwargs)   
         
-class Results(object):
-    def __init__(self, model=None, data=None, filename=None):
-        if data is not None and model is not None:
-            self.copy_data(data)
-            self.copy_model(model)
-        elif filename is not None:
-            self.read(filename)
-        else:
-            print("ERROR: Results() object must have model and data keywords OR filename keyword to initialize.")            
+def write_history(filename, values):
+    with h5py.File(filename,'w') as f:
+        for attr, value in values.items():
+            f.create_dataset(attr, data=value)
             
-    def copy_data(self, data):
-        for attr in DATA_NP_ATTRS:
-            setattr(self, attr, getattr(data,attr))   
-        session = get_session()
-        for attr in DATA_TF_ATTRS:
-            setattr(self, attr, session.run(getattr(data,attr)))
-            
-    def copy_model(self, model):
-        self.component_names = model.component_names
-        session = get_session()
-        self.ys_predicted = [session.run(model.synthesize(r)) for r in range(self.R)]
-        for c in model.components:
-            basename = c.name+'_'
-            ys_predicted = [session.run(c.synthesize(r)) for r in range(self.R)]
-            setattr(self, basename+'ys_predicted', ys_predicted)
-            for attr in COMPONENT_NP_ATTRS:
-                setattr(self, basename+attr, getattr(c,attr))
-            for attr in COMPONENT_TF_ATTRS:
-                try:
-                    setattr(self, basename+attr, session.run(getattr(c,attr)))
-                except: # catch when basis vectors are Nones
-                    assert c.K == 0, "Results: copy_model() failed on attribute {0}".format(attr)
-                    
-    def update_order_model(self, model, r):
-        session = get_session()
-        self.ys_predicted[r] = session.run(model.synthesize(r))
-        for c in model.components:
-            basename = c.name+'_'
-            ys_predicted = session.run(c.synthesize(r))
-            getattr(self, basename+'ys_predicted')[r] = ys_predicted
-            for attr in COMPONENT_NP_ATTRS:
-                if type(getattr(c,attr)) == list: # skip attributes common to all orders
-                    getattr(self, basename+attr)[r] = getattr(c,attr)[r]
-            for attr in COMPONENT_TF_ATTRS:
-                try:
-                    getattr(self, basename+attr)[r] = session.run(getattr(c,attr)[r])
-                except: # catch when basis vectors are Nones
-                    assert c.K == 0, "Results: update_order_model() failed on attribute {0}".format(attr)
-                    
-    def compute_final_rvs(self):
-        for c in model.components:
+def prepare_order(model, data, r, compile=False, metrics=None, initialize=True):
+    """
+    Common start of the optimize_order*() functions: metrics for order r (a new 
+    in-memory Metrics if None) and compile set on all components. With initialize, 
+    the order is copied into the session if it is not yet and its templates are 
+    initialized if they do not exist. Returns the metrics.
+    """
+    if metrics is None:
+        metrics = Metrics() # in-memory only
+    metrics.context['order'] = r
+    if initialize:
+        data.to_tensors(orders=[r]) # attached data is copied into the session order by order
+        with metrics.phase('template_init'):
+            if not all(c.template_exists[r] for c in model.components):
+                model.initialize_templates(data, orders=[r])
+    for c in model.components:
+        c.compiled = compile
+    return metrics
+
+def regularization_nll(components, r, scale=1., taper=None, weights_scale=1.):
+    """
+    L1 and L2 regularization of the templates and basis vectors of order r, times 
+    scale, plus L2 regularization of the basis weights, times weights_scale (None 
+    leaves it out). taper takes one (node weights, column weights) pair per 
+    component to weight the template nodes and basis vector columns by.
+    """
+    nll = 0.
+    for j,c in enumerate(components):
+        w_template, w_columns = 1., 1.
+        if taper is not None:
+            w_template, w_columns = [tf.constant(w, dtype=c.template_ys[r].dtype.base_dtype) for w in taper[j]]
+        nll += scale * c.L1_template[r] * reduce_sum64(w_template * tf.abs(c.template_ys[r]))
+        nll += scale * c.L2_template[r] * reduce_sum64(w_template * tf.square(c.template_ys[r]))
+        if c.K > 0:
+            nll += scale * c.L1_basis_vectors[r] * reduce_sum64(w_columns * tf.abs(c.basis_vectors[r]))
+            nll += scale * c.L2_basis_vectors[r] * reduce_sum64(w_columns * tf.square(c.basis_vectors[r]))
+            if weights_scale is not None:
+                nll += weights_scale * c.L2_basis_weights[r] * reduce_sum64(tf.square(c.basis_weights[r]))
+    return nll
+
+def make_steps(components, r, nll, rv_solver='adam', group=False, sparse=False):
+    """
+    Optimizers for order r of all components (see Component.make_optimizers()) 
+    and the training steps that use them, by kind of RV step (True for 
+    Gauss-Newton steps): with group, one op that computes all gradients before 
+    it applies any update (see group_updates()), otherwise a list of ops to run 
+    one after the other. The optimizers still need to be initialized.
+    """
+    for c in components:
+        c.make_optimizers(r, nll, sparse=sparse)
+        if rv_solver != 'adam' and not c.rvs_fixed:
+            c.make_newton_rvs(r, [x for x in components if x!=c])
+    steps = {}
+    for newton in {'adam': [False], 'newton': [True], 'alternate': [False, True]}[rv_solver]:
+        updates, rv_steps, ops = [], [], []
+        for c in components:
             if not c.rvs_fixed:
-                c.combine_orders()
-                basename = c.name+'_'
-                setattr(self, basename+'time_rvs', c.time_rvs)
-                setattr(self, basename+'order_rvs', c.order_rvs)
-                setattr(self, basename+'order_sigmas', c.order_sigmas)
-                        
-    def read(self, filename):
-        print("Results: reading from {0}".format(filename))
-        with h5py.File(filename,'r') as f:
-            for attr in np.append(DATA_NP_ATTRS, DATA_TF_ATTRS):
-                setattr(self, attr, np.copy(f[attr]))
-            self.component_names = np.copy(f['component_names'])
-            self.component_names = [a.decode('utf8') for a in self.component_names] # h5py workaround
-            self.ys_predicted = np.copy(f['ys_predicted'])
-            for name in self.component_names:
-                basename = name + '_'
-                for attr in np.append(COMPONENT_NP_ATTRS, COMPONENT_TF_ATTRS):
-                    try:
-                        setattr(self, basename+attr, np.copy(f[basename+attr]))
-                    except: # catch when basis vectors are Nones
-                        assert np.copy(f[basename+'K']) == 0, "Results: read() failed on attribute {0}".format(basename+attr)
-                setattr(self, basename+'ys_predicted', np.copy(f[basename+'ys_predicted']))
-                    
-    def write(self, filename):
-        print("Results: writing to {0}".format(filename))
-        self.component_names = [a.encode('utf8') for a in self.component_names] # h5py workaround
-        with h5py.File(filename,'w') as f:
-            for attr in vars(self):
-                f.create_dataset(attr, data=getattr(self, attr))         
-            
+                if newton: # Gauss-Newton step on RVs
+                    rv_steps.append((c.rvs_block[r], c.step_rvs_newton))
+                    ops.append(c.opt_rvs_newton)
+                else:
+                    updates.append(c.updates['rvs'])
+                    ops.append(c.opt_rvs)
+            updates.append(c.updates['template'])
+            ops.append(c.opt_template)
+            if c.K > 0:
+                updates += [c.updates['basis_vectors'], c.updates['basis_weights']]
+                ops.append(c.opt_basis)
+        steps[newton] = group_updates(updates, rv_steps) if group else ops
+    return steps
 
-def optimize_order(model, data, r, results=None, niter=100, save_every=100, save_history=False, basename='wobble'):
+@in_context
+def optimize_order(model, data, r, results=None, niter=100, save_every=100, save_history=False, basename='wobble',
+                   rv_solver='adam', compile=False, metrics=None, n_chunks=1, chunk_overlap=128, chunk_mode='parallel',
+                   batch_size=None, writer=None, coarse_schedule=None):
     '''
     optimize the model for order r in data
+    rv_solver options: 'adam', 'newton' (batched Gauss-Newton steps), 'alternate' (both on alternating iterations)
+    compile keyword JIT-compiles the training step with XLA and runs all of its 
+    updates as one grouped op in a single session call: all gradients are computed 
+    before any update is applied (so the updates are simultaneous rather than sequential)
+    metrics keyword takes a Metrics object to record timings and memory use in
+    n_chunks > 1 splits the order into overlapping wavelength chunks, see optimize_order_chunked()
+    batch_size keyword takes stochastic steps on batches of epochs read from disk, see optimize_order_minibatch()
+    results and history saves are written in the background while the optimization goes on, by the 
+    BackgroundWriter given as writer keyword or else by one that is started on the first progress 
+    save and flushed before returning (a final save without progress saves is written directly)
+    coarse_schedule keyword takes a list of (factor, fraction of niter) stages to run at lower 
+    resolution first, see optimize_order_multires()
     '''      
-    for c in model.components:
-        if ~c.template_exists[r]:
-            c.initialize_template(r, data, other_components=[x for x in model.components if x!=c])
+    assert rv_solver in ['adam', 'newton', 'alternate'], "rv_solver not recognized."
+    if coarse_schedule is not None:
+        assert batch_size is None and not data.stream and n_chunks == 1, \
+            "coarse-to-fine optimization does not support minibatches or chunks."
+        return optimize_order_multires(model, data, r, schedule=coarse_schedule, results=results, niter=niter, 
+                                       compile=compile, metrics=metrics, save_every=save_every, 
+                                       save_history=save_history, basename=basename, rv_solver=rv_solver, 
+                                       writer=writer)
+    if batch_size is not None or data.stream:
+        assert rv_solver == 'adam' and not save_history and n_chunks == 1, \
+            "minibatch optimization only supports rv_solver='adam' without history or chunks."
+        return optimize_order_minibatch(model, data, r, batch_size=batch_size or 64, results=results, niter=niter, 
+                                        compile=compile, metrics=metrics)
+    if n_chunks > 1:
+        assert rv_solver == 'adam' and not save_history, "chunked optimization only supports rv_solver='adam' without history."
+        return optimize_order_chunked(model, data, r, n_chunks=n_chunks, overlap=chunk_overlap, mode=chunk_mode, 
+                                      results=results, niter=niter, compile=compile, metrics=metrics)
+    metrics = prepare_order(model, data, r, compile=compile, metrics=metrics)
                 
-    # likelihood calculation:
-    synth = model.synthesize(r)
-    chis = (data.ys[r] - synth) * tf.sqrt(data.ivars[r])
-    nll = 0.5*tf.reduce_sum(tf.square(tf.boolean_mask(data.ys[r], data.epoch_mask) 
-                                      - tf.boolean_mask(synth, data.epoch_mask)) 
-                            * tf.boolean_mask(data.ivars[r], data.epoch_mask))
-    
-    # regularization:
-    for c in model.components:
-        nll += c.L1_template[r] * tf.reduce_sum(tf.abs(c.template_ys[r]))
-        nll += c.L2_template[r] * tf.reduce_sum(tf.square(c.template_ys[r]))
-        if c.K > 0:
-            nll += c.L1_basis_vectors[r] * tf.reduce_sum(tf.abs(c.basis_vectors[r]))
-            nll += c.L2_basis_vectors[r] * tf.reduce_sum(tf.square(c.basis_vectors[r]))
-            nll += c.L2_basis_weights[r] * tf.reduce_sum(tf.square(c.basis_weights[r]))
-        
-    # set up optimizers: 
-    for c in model.components:
-        c.make_optimizers(r, nll)
+    with metrics.phase('graph_build'):
+        with jit_scope(compile):
+            # likelihood calculation:
+            synth = model.synthesize(r)
+            chis = (data.ys[r] - synth) * tf.sqrt(data.pixel_ivars(r))
+            nll = data.nll(r, synth) + regularization_nll(model.components, r)
+            # set up optimizers, one grouped op per kind of RV step if compiled: 
+            train_ops = make_steps(model.components, r, nll, rv_solver=rv_solver, group=compile)
 
-    session = get_session()
-    session.run(tf.global_variables_initializer())  # TODO: is this overwriting anything important?
+        session = get_session()
+        session.run(tf.variables_initializer([v for c in model.components for v in c.optimizer_variables]))
+    metrics.graph()
     
     # initialize helper classes:
     if save_history:
         history = History(model, data, r, niter)   
     if results is None: 
-        results = Results(model=model, data=data)
+        with metrics.phase('results_init'):
+            results = Results(model=model, data=data)
         
     # optimize:
-    for i in tqdm(range(niter), total=niter, miniters=int(niter/10)):
-        if save_history:
-            history.save_iter(model, data, i, nll, chis)           
+    own_writer = writer is None # then one is started on the first progress save, if any
+    try:
+        with metrics.phase('iterations', niter=niter):
+            for i in tqdm(range(niter), total=niter, miniters=int(niter/10)):
+                if save_history:
+                    with metrics.phase('history_save_iter'):
+                        history.save_iter(model, data, i, nll, chis)           
+                start = time()
+                newton = rv_solver == 'newton' or (rv_solver == 'alternate' and i % 2 == 0)
+                if compile:
+                    metrics.run(session, train_ops[newton], i)
+                else:
+                    for op in train_ops[newton]: # RVs, template and basis of each component in turn
+                        metrics.run(session, op, i)
+                metrics.step(i, time() - start)
+                if (i+1) % save_every == 0 and i+1 < niter: # progress save
+                    if writer is None:
+                        writer = BackgroundWriter()
+                    with metrics.phase('results_save'):
+                        results.update_order_model(model, r) # update
+                        results.write(basename+'_results.hdf5', writer=writer)
+                    if save_history:
+                        with metrics.phase('history_save'):
+                            history.write(basename+'_o{0}_history.hdf5'.format(r), writer=writer)
+                
+        if save_history: # final post-optimization save
+            with metrics.phase('history_save'):
+                history.write(basename+'_o{0}_history.hdf5'.format(r), writer=writer)
+    finally:
+        if own_writer and writer is not None:
+            with metrics.phase('write_flush'):
+                writer.close() # everything saved is on disk
+    with metrics.phase('results_update'):
+        results.update_order_model(model, r) # update
+    return results
+
+@in_context
+def optimize_order_chunked(model, data, r, n_chunks=4, overlap=128, mode='parallel', results=None, niter=100, 
+                           compile=False, metrics=None):
+    '''
+    optimize the model for order r in data, split into n_chunks chunks of pixel columns 
+    that overlap by overlap columns. Each chunk fits its own slice of every template 
+    (and of the basis vectors) to its own columns only, which keeps the working set small. 
+    Across the overlaps the chunk likelihoods are tapered so that they add up to the full 
+    one; the RVs and basis weights are shared and take Adam steps on the summed gradient.
+    mode options: 'parallel' (all chunks in one session call, which TensorFlow runs concurrently) 
+    or 'sequential' (one chunk at a time, accumulating the gradient of the shared parameters); 
+    both make the same updates, since all gradients of a step are taken before any update 
+    (see compare_chunk_modes()).
+    At the end the chunk templates are blended into the full templates with the same tapers.
+    '''
+    assert mode in ['parallel', 'sequential'], "mode not recognized."
+    metrics = prepare_order(model, data, r, compile=compile, metrics=metrics)
+    
+    session = get_session()
+    with metrics.phase('graph_build'):
+        xs = session.run(data.xs[r])
+        M = xs.shape[1]
+        bounds, columns = chunk_columns(M, n_chunks, overlap)
+        column_weights = [chunk_taper(np.arange(M), bounds, k, overlap) for k in range(n_chunks)]
+        # template nodes of each chunk, and their weights in the final blend:
+        nodes, node_weights = [], []
         for c in model.components:
-            if not c.rvs_fixed:            
-                session.run(c.opt_rvs) # optimize RVs
-            session.run(c.opt_template) # optimize mean template
-            if c.K > 0:
-                session.run(c.opt_basis) # optimize variable components
-        if (i+1 % save_every == 0): # progress save
-            results.copy_model(model) # update
-            results.write(basename+'_results.hdf5'.format(r))
-            if save_history:
-                history.write(basename+'_o{0}_history.hdf5'.format(r))
+            template_xs, rvs = session.run([c.template_xs[r], c.rvs_block[r]])
+            rest_xs = xs + np.log(doppler_np(rvs))[:, None]
+            positions = np.interp(template_xs, np.mean(rest_xs, axis=0), np.arange(M)) # in columns
+            pad = 10
+            c_nodes, c_weights = [], []
+            for k,(start, stop) in enumerate(columns):
+                weights = chunk_taper(positions, bounds, k, overlap)
+                used = np.nonzero(weights)[0]
+                first = min(used[0], np.searchsorted(template_xs, np.min(rest_xs[:, start:stop]))) - pad
+                last = max(used[-1] + 1, np.searchsorted(template_xs, np.max(rest_xs[:, start:stop]), side='right')) + pad
+                c_nodes.append((max(0, first), min(len(template_xs), last)))
+                c_weights.append(weights)
+            nodes.append(c_nodes)
+            node_weights.append(c_weights)
+            
+        with jit_scope(compile):
+            chunks, chunk_nlls = [], []
+            for k in range(n_chunks):
+                data_k = data.chunk(r, columns[k], weights=column_weights[k][columns[k][0]:columns[k][1]])
+                components_k = [c.chunk(r, data_k, nodes[j][k], columns[k]) for j,c in enumerate(model.components)]
+                synth = tf.zeros_like(data_k.ys[r])
+                for c in components_k:
+                    synth += c.synthesize(r)
+                # regularization, tapered like the data (the basis weights are regularized once, below):
+                taper = [(node_weights[j][k][nodes[j][k][0]:nodes[j][k][1]], 
+                          column_weights[k][columns[k][0]:columns[k][1]]) for j in range(len(components_k))]
+                nll = data_k.nll(r, synth) + regularization_nll(components_k, r, taper=taper, weights_scale=None)
+                chunks.append(components_k)
+                chunk_nlls.append(nll)
+                
+            # set up optimizers: chunk parameters...
+            new_variables = []
+            chunk_updates = [[] for k in range(n_chunks)] # (optimizer, grads_and_vars), see group_updates()
+            for k,components_k in enumerate(chunks):
+                for c in components_k:
+                    c.make_optimizers(r, chunk_nlls[k], shared=False)
+                    new_variables.append(c.template_ys[r])
+                    chunk_updates[k].append(c.updates['template'])
+                    if c.K > 0:
+                        new_variables.append(c.basis_vectors[r])
+                        chunk_updates[k].append(c.updates['basis_vectors'])
+            # ...and shared parameters:
+            shared = [] # (variable, shape, learning rate, regularization)
+            for c in model.components:
+                if not c.rvs_fixed:
+                    shared.append((c.rvs_block[r], data.N, c.learning_rate_rvs, None))
+                if c.K > 0:
+                    shared.append((c.basis_weights[r], (data.N, c.K), c.learning_rate_basis, 
+                                   c.L2_basis_weights[r] * reduce_sum64(tf.square(c.basis_weights[r]))))
+            shared_updates, accumulations, accumulators = [], [[] for k in range(n_chunks)], []
+            for var, shape, learning_rate, regularization in shared:
+                grads = [tf.gradients(chunk_nll, var)[0] for chunk_nll in chunk_nlls]
+                if mode == 'sequential':
+                    accumulator = tf.Variable(np.zeros(shape), dtype=var.dtype.base_dtype, name='gradient_accumulator')
+                    accumulators.append(accumulator)
+                    for k in range(n_chunks):
+                        accumulations[k].append((accumulator, grads[k]))
+                    grad = tf.identity(accumulator)
+                else:
+                    grad = tf.add_n(grads)
+                if regularization is not None:
+                    grad += tf.gradients(regularization, var)[0]
+                shared_updates.append((tf.train.AdamOptimizer(learning_rate), [(grad, var)]))
+            # each step computes all of its gradients before it updates anything:
+            if mode == 'sequential':
+                chunk_steps = [group_updates(chunk_updates[k], accumulations[k]) for k in range(n_chunks)]
+                shared_step = group_updates(shared_updates)
+                with tf.control_dependencies([shared_step]):
+                    shared_step = tf.group(*[tf.assign(a, tf.zeros_like(a)) for a in accumulators])
+            else:
+                step = group_updates([u for updates in chunk_updates for u in updates] + shared_updates)
+                
+        optimizers = [o for updates in chunk_updates + [shared_updates] for o,_ in updates]
+        new_variables += accumulators + [v for o in optimizers for v in o.variables()]
+        session.run(tf.variables_initializer(new_variables))
+    metrics.graph()
+    
+    if results is None: 
+        with metrics.phase('results_init'):
+            results = Results(model=model, data=data)
+            
+    # optimize:
+    with metrics.phase('iterations', niter=niter):
+        for i in tqdm(range(niter), total=niter, miniters=int(niter/10)):
+            start = time()
+            if mode == 'sequential':
+                for k in range(n_chunks):
+                    metrics.run(session, chunk_steps[k], i)
+                metrics.run(session, shared_step, i)
+            else:
+                metrics.run(session, step, i)
+            metrics.step(i, time() - start)
+            
+    with metrics.phase('stitch'):
+        for j,c in enumerate(model.components):
+            template_ys = session.run(c.template_ys[r])
+            blend, total = np.zeros_like(template_ys), np.zeros_like(template_ys)
+            chunk_values = session.run([chunks[k][j].template_ys[r] for k in range(n_chunks)])
+            for k,values in enumerate(chunk_values):
+                first, last = nodes[j][k]
+                blend[first:last] += node_weights[j][k][first:last] * values
+                total[first:last] += node_weights[j][k][first:last]
+            values = {c.template_ys[r]: np.where(total > 0., blend / np.maximum(total, 1.e-12), template_ys)}
+            if c.K > 0: # column weights add up to one everywhere
+                basis_vectors = np.zeros_like(session.run(c.basis_vectors[r]))
+                chunk_values = session.run([chunks[k][j].basis_vectors[r] for k in range(n_chunks)])
+                for k,values_k in enumerate(chunk_values):
+                    start, stop = columns[k]
+                    basis_vectors[:, start:stop] += column_weights[k][start:stop] * values_k
+                values[c.basis_vectors[r]] = basis_vectors
+            c.assign(values)
+    with metrics.phase('results_update'):
+        results.update_order_model(model, r) # update
+    return results
+
+@in_context
+def optimize_order_minibatch(model, data, r, batch_size=64, prefetch=4, init_epochs=None, results=None, niter=100, 
+                             seed=None, compile=False, metrics=None):
+    '''
+    optimize the model for order r in data with stochastic steps on random batches of 
+    batch_size epochs. The batches are read from the data file and prepared in a 
+    background thread (up to prefetch of them ahead), so memory use is set by the 
+    batch size rather than by the number of epochs; data can be a Data(stream=True).
+    The likelihood of each batch is scaled up to all epochs. The templates take Adam 
+    steps on every batch, while the RVs and basis weights of the epochs in the batch 
+    take sparse (lazy) Adam steps that leave all other epochs alone.
+    Templates that do not exist yet are initialized from init_epochs random epochs 
+    (default: 4 batches).
+    Returns results updated for order r (lean Results for streamed data, see Results).
+    '''
+    metrics = prepare_order(model, data, r, compile=compile, metrics=metrics, initialize=False) # from batches, below
+    session = get_session()
+    reader = EpochReader(data.origin_file, data.orders[r], min_flux=data.min_flux)
+    available = np.arange(data.N)[np.asarray(data.epoch_mask, dtype=bool)]
+    batch = data.batch(r)
+    epochs = tf.placeholder(tf.int32, shape=[None], name='epochs_batch')
+    components = [c.batch(r, batch, epochs) for c in model.components]
+    
+    def feed(batch_epochs, arrays):
+        xs, ys, ivars = arrays
+        return {epochs: batch_epochs, batch.xs[r]: xs, batch.ys[r]: ys, batch.ivars[r]: ivars}
+    
+    with metrics.phase('template_init'):
+        if not all(c.template_exists[r] for c in model.components):
+            if init_epochs is None:
+                init_epochs = 4 * batch_size
+            sample = next(epoch_batches(available, init_epochs, 1, seed=seed))
+            feed_dict = feed(sample, reader.read(sample))
+            for c in model.components: # start from scratch, as in Model.initialize_templates()
+                c.template_exists[r] = False
+            for c,b in zip(model.components, components):
+                session.run(c.rvs_block[r].initializer)
+                resids = 1. * batch.ys[r]
+                for other in components: # subtract off initialized components
+                    if other is not b and other.template_exists[r]:
+                        resids -= other.shift_and_interp(r, other.rvs_block[r])
+                xs, resids, rvs, ivars = session.run([batch.xs[r], resids, b.rvs_block[r], batch.ivars[r]], 
+                                                     feed_dict=feed_dict)
+                c.templates_from_residuals([r], [xs], [resids], [rvs], [ivars], epochs=sample)
+            reader.close()
+    
+    with metrics.phase('graph_build'):
+        with jit_scope(compile):
+            synth = tf.zeros_like(batch.ys[r])
+            for c in components:
+                synth += c.synthesize(r)
+            scale = len(available) / tf.cast(tf.size(epochs), tf.float64) # batch -> all epochs
+            nll = scale * 0.5 * reduce_sum64(tf.square(batch.ys[r] - synth) * batch.ivars[r])
+            nll += regularization_nll(components, r, weights_scale=scale)
+            # set up optimizers on the full variables, all gradients taken before any update:
+            step = make_steps(model.components, r, nll, group=True, sparse=True)[False]
+        session.run(tf.variables_initializer([v for c in model.components for v in c.optimizer_variables]))
+    metrics.graph()
+    
+    # optimize:
+    prefetcher = Prefetcher(reader, epoch_batches(available, batch_size, niter, seed=seed), size=prefetch)
+    try:
+        with metrics.phase('iterations', niter=niter):
+            for i,(batch_epochs, arrays) in enumerate(tqdm(prefetcher, total=niter, miniters=int(niter/10))):
+                start = time()
+                metrics.run(session, step, i, feed_dict=feed(batch_epochs, arrays))
+                metrics.step(i, time() - start)
+    finally:
+        prefetcher.close()
                 
-    if save_history: # final post-optimization save
-        history.write(basename+'_o{0}_history.hdf5'.format(r))
-    results.update_order_model(model, r) # update
+    if results is None:
+        with metrics.phase('results_init'):
+            results = Results(model=model, data=data, lean=data.stream)
+    else:
+        with metrics.phase('results_update'):
+            results.update_order_model(model, r) # update
     return results
 
-def optimize_orders(model, data, **kwargs):
+@in_context
+def optimize_order_multires(model, data, r, schedule=((4, 0.5), (2, 0.25)), results=None, niter=100, compile=False, 
+                            metrics=None, **kwargs):
+    '''
+    optimize the model for order r in data from coarse to fine: for each (factor, fraction) in 
+    schedule, that fraction of the niter steps is taken on every factor-th template node against 
+    the data binned down by factor in pixels (see Data.bin() and Component.coarse()), after which 
+    the changes to the templates and basis vectors are upsampled and added to the full-resolution 
+    ones (see Component.refine()); compare_multires() checks the RVs against a plain fit. The remaining steps 
+    refine everything at full resolution with optimize_order(), which gets all other keywords.
+    The RVs and basis weights are the same variables at all resolutions.
+    '''
+    metrics = prepare_order(model, data, r, compile=compile, metrics=metrics)
+    session = get_session()
+    coarse_niter = 0
+    for factor, fraction in schedule:
+        n = int(round(fraction * niter))
+        coarse_niter += n
+        if n == 0:
+            continue
+        metrics.context['factor'] = factor
+        with metrics.phase('graph_build'):
+            with jit_scope(compile):
+                data_f = data.bin(r, factor)
+                components_f = [c.coarse(r, data_f, factor) for c in model.components]
+                synth = tf.zeros_like(data_f.ys[r])
+                for c in components_f:
+                    synth += c.synthesize(r)
+                # regularization scaled up to the full number of nodes and columns:
+                nll = data_f.nll(r, synth) + regularization_nll(components_f, r, scale=factor)
+                steps = make_steps(components_f, r, nll, group=compile)[False] # same steps as in optimize_order()
+                new_variables = [c.template_ys[r] for c in components_f]
+                new_variables += [c.basis_vectors[r] for c in components_f if c.K > 0]
+            session.run(tf.variables_initializer(new_variables + [v for c in components_f for v in c.optimizer_variables]))
+        metrics.graph()
+        
+        with metrics.phase('iterations', niter=n):
+            for i in tqdm(range(n), total=n, miniters=int(n/10)):
+                start = time()
+                if compile:
+                    metrics.run(session, steps, i)
+                else:
+                    for op in steps:
+                        metrics.run(session, op, i)
+                metrics.step(i, time() - start)
+        with metrics.phase('refine'):
+            for c, c_f in zip(model.components, components_f):
+                c.refine(r, c_f, factor)
+    metrics.context.pop('factor', None)
+    return optimize_order(model, data, r, results=results, niter=niter - coarse_niter, compile=compile, 
+                          metrics=metrics, **kwargs)
+
+@in_context
+def optimize_orders(model, data, metrics=None, **kwargs):
     """
     optimize model for all orders in data
+    metrics keyword takes a Metrics object to record timings and memory use in
+    """
+    if metrics is None:
+        metrics = Metrics() # in-memory only
+    kwargs['metrics'] = metrics
+    if not data.stream: # streamed data are initialized from sampled epochs in optimize_order_minibatch()
+        with metrics.phase('template_init'):
+            model.initialize_templates(data) # all orders in one pass
+    with BackgroundWriter() as writer: # for the saves of all orders; flushed at the end
+        kwargs['writer'] = writer
+        for r in range(data.R):
+            print("--- ORDER {0} ---".format(r))
+            if r == 0: 
+                results = optimize_order(model, data, r, **kwargs)
+            else:
+                results = optimize_order(model, data, r, results=results, **kwargs)
+            #if (r % 5) == 0:
+            #    results.write('results_order{0}.hdf5'.format(r), writer=writer)
+        with metrics.phase('results_save'):
+            results.write('results.hdf5', writer=writer)
+            writer.flush()
+    metrics.context = {}
+    metrics.emit('summary', **metrics.summary())
+    return results    
+
+@in_context
+def optimize_rvs_order(model, data, r, niter=80):
+    """
+    Fit only the RVs and basis weights for order r with all templates and basis
+    vectors held fixed, e.g. after Model.load_templates(). The graph and optimizers
+    are built once per order and data object and reused on later calls, until the
+    next Model.load_templates().
+    Returns a list of RV arrays, one per model component.
     """
     session = get_session()
-    #session.run(tf.global_variables_initializer())    # should this be in get_session?
-    for r in range(data.R):
-        print("--- ORDER {0} ---".format(r))
-        if r == 0: 
-            results = optimize_order(model, data, r, **kwargs)
-        else:
-            results = optimize_order(model, data, r, results=results, **kwargs)
-        #if (r % 5) == 0:
-        #    results.write('results_order{0}.hdf5'.format(r))
-    results.write('results.hdf5')    
-    return results    
\ No newline at end of file
+    key = (r, data) # by identity: the graph reads this data object's tensors
+    data.to_tensors(orders=[r])
+    if key not in model.rv_fitters:
+        synth = model.synthesize(r)
+        nll = data.nll(r, synth)
+        for c in model.components:
+            if c.K > 0:
+                nll += c.L2_basis_weights[r] * reduce_sum64(tf.square(c.basis_weights[r]))
+        opts, init_vars = [], []
+        for c in model.components:
+            if not c.rvs_fixed:
+                optimizer = tf.train.AdamOptimizer(c.learning_rate_rvs)
+                opts.append(optimizer.minimize(nll, var_list=[c.rvs_block[r]]))
+                init_vars += [c.rvs_block[r]] + optimizer.variables()
+            if c.K > 0:
+                optimizer = tf.train.AdamOptimizer(c.learning_rate_basis)
+                opts.append(optimizer.minimize(nll, var_list=[c.basis_weights[r]]))
+                init_vars += [c.basis_weights[r]] + optimizer.variables()
+        model.rv_fitters[key] = (opts, tf.variables_initializer(init_vars))
+    opts, init = model.rv_fitters[key]
+    session.run(init) # restart from the initial guesses
+    for i in range(niter):
+        for opt in opts:
+            session.run(opt)
+    return session.run([c.rvs_block[r] for c in model.components])
+
+@in_context
+def infer_rvs(model, data, niter=80):
+    """
+    Measure RVs for new epochs in data using the templates in model, which
+    should be fixed first with Model.load_templates().
+    Returns a dictionary of (R, N) RV arrays keyed by component name.
+    """
+    rvs = {name: np.zeros((data.R, data.N)) for name in model.component_names}
+    for r in tqdm(range(data.R), total=data.R):
+        order_rvs = optimize_rvs_order(model, data, r, niter=niter)
+        for name,v in zip(model.component_names, order_rvs):
+            rvs[name][r,:] = v
+    return rvs
+
+def optimize_orders_coadded(data, build_model, max_dt=0.2, max_dberv=100., niter=100, rv_niter=80, **kwargs):
+    """
+    Learn the templates from co-added exposures (see Data.coadd()), then fit the RVs 
+    of every exposure in data with the templates held fixed (see infer_rvs()). 
+    build_model is a function that makes the model for some data, e.g.
+    
+        def build_model(data):
+            model = Model(data)
+            model.add_star('star')
+            model.add_telluric('tellurics', variable_bases=2)
+            return model
+    
+    Extra keywords are passed to optimize_orders().
+    Returns the results of the template fit to the co-added data and a dictionary 
+    of (R, N) per-exposure RV arrays keyed by component name.
+    """
+    coadded = data.coadd(max_dt=max_dt, max_dberv=max_dberv)
+    print("co-added {0} exposures into {1} epochs".format(sum(len(g) for g in coadded.groups), coadded.N))
+    results = optimize_orders(build_model(coadded), coadded, niter=niter, **kwargs)
+    model = build_model(data)
+    model.load_templates(results)
+    return results, infer_rvs(model, data, niter=rv_niter)
+
+def fit_star_rvs(filename, filepath, orders, niter, variable_bases, data_kwargs={}, order_kwargs={}):
+    """
+    Fit a star + tellurics model to each order in its own Context (closed afterwards).
+    data_kwargs are passed to Data() and order_kwargs to optimize_order().
+    Returns the star RVs, one row per order.
+    """
+    context = Context()
+    try:
+        data = Data(filename, filepath=filepath, orders=orders, context=context, **data_kwargs)
+        model = Model(data)
+        model.add_star('star')
+        model.add_telluric('tellurics', variable_bases=variable_bases)
+        for r in range(data.R):
+            optimize_order(model, data, r, niter=niter, **order_kwargs)
+        return np.asarray(context.run(model.components[0].rvs_block))
+    finally:
+        context.close()
+        
+def compare_rvs(rvs, reference, orders, label):
+    """
+    Per-order RMS and maximum absolute difference (m/s) of rvs from reference, 
+    after taking out the (arbitrary) zero-point of each order; printed under label.
+    """
+    diffs = rvs - reference
+    diffs -= np.mean(diffs, axis=1)[:, None] # absolute zero-points are arbitrary
+    comparison = {'orders': orders, 
+                  'rms_diff': np.sqrt(np.mean(diffs**2, axis=1)), 
+                  'max_diff': np.max(np.abs(diffs), axis=1)}
+    for o,rms,mx in zip(orders, comparison['rms_diff'], comparison['max_diff']):
+        print("order {0}: {1} RV difference RMS {2:.3f} m/s, max {3:.3f} m/s".format(o, label, rms, mx))
+    return comparison
+
+def compare_precision(filename, filepath='../data/', orders=[30], niter=100, variable_bases=0, **kwargs):
+    """
+    Fit the same data with a star + tellurics model in float64 and in float32 
+    and report how much the star RVs differ.
+    Extra keywords are passed to Data().
+    Each fit runs in its own Context, which is closed afterwards.
+    Returns a dictionary with the per-order RMS and maximum absolute RV difference (m/s).
+    """
+    rvs = [fit_star_rvs(filename, filepath, orders, niter, variable_bases, data_kwargs=dict(kwargs, dtype=dtype)) 
+           for dtype in [tf.float64, tf.float32]]
+    return compare_rvs(rvs[1], rvs[0], orders, 'float32 - float64')
+
+def compare_chunk_modes(filename, filepath='../data/', orders=[30], niter=100, variable_bases=0, n_chunks=4, 
+                        **kwargs):
+    """
+    Fit the same data split into n_chunks chunks in 'parallel' and in 'sequential' mode 
+    (see optimize_order_chunked()), which should give the same RVs up to rounding, 
+    and report how much the star RVs differ.
+    Extra keywords are passed to Data().
+    Returns a dictionary with the per-order RMS and maximum absolute RV difference (m/s).
+    """
+    rvs = [fit_star_rvs(filename, filepath, orders, niter, variable_bases, data_kwargs=kwargs, 
+                        order_kwargs={'n_chunks': n_chunks, 'chunk_mode': mode}) 
+           for mode in ['parallel', 'sequential']]
+    return compare_rvs(rvs[1], rvs[0], orders, 'sequential - parallel')
+
+def compare_multires(filename, filepath='../data/', orders=[30], niter=100, variable_bases=0, 
+                     schedule=((4, 0.5), (2, 0.25)), **kwargs):
+    """
+    Fit the same data at full resolution only and from coarse to fine with schedule 
+    (see optimize_order_multires()), with the same total number of steps, and 
+    report how much the star RVs differ.
+    Extra keywords are passed to Data().
+    Returns a dictionary with the per-order RMS and maximum absolute RV difference (m/s).
+    """
+    rvs = [fit_star_rvs(filename, filepath, orders, niter, variable_bases, data_kwargs=kwargs, 
+                        order_kwargs=order_kwargs) for order_kwargs in [{}, {'coarse_schedule': schedule}]]
+    return compare_rvs(rvs[1], rvs[0], orders, 'coarse-to-fine - full')
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import division, print_function
+
+__all__ = ["BackgroundWriter", "write_atomic"]
+
+import os
+import threading
+try:
+    import queue
+except ImportError: # python 2
+    import Queue as queue
+
+
+def write_atomic(filename, write, *args):
+    """
+    write(tmpfile, *args) into a temporary file next to filename, then rename it
+    to filename, so that filename is never left half written.
+    """
+    tmp = filename + '.tmp'
+    try:
+        write(tmp, *args)
+        os.rename(tmp, filename) # atomic
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class BackgroundWriter(object):
+    """
+    Writes files in a background thread while the optimization goes on.
+    submit() hands over a write function with a snapshot of what to write
+    (which must not change afterwards); it blocks while max_pending writes
+    are queued, so that snapshots cannot pile up in memory. Each file is
+    written atomically (see write_atomic). flush() waits until everything
+    submitted is on disk and raises the first error of a failed write.
+    """
+    def __init__(self, max_pending=2):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.errors = []
+        self.thread = threading.Thread(target=self.work)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None: # closed
+                    return
+                filename, write, args = item
+                write_atomic(filename, write, *args)
+            except Exception as e: # raised by flush()
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, filename, write, *args):
+        """
+        Write filename with write(filename, *args) in the background.
+        """
+        if self.thread is None:
+            raise RuntimeError("BackgroundWriter: used after close()")
+        self.queue.put((filename, write, args))
+
+    def flush(self):
+        self.queue.join()
+        if len(self.errors) > 0:
+            error, self.errors = self.errors[0], []
+            raise error
+
+    def close(self):
+        """
+        Flush, then stop the thread.
+        """
+        if self.thread is None:
+            return
+        try:
+            self.flush()
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -50,20 +50,15 @@ if __name__ == "__main__":
             plt.savefig(plot_dir+'nll_order{0}.png'.format(r))   
             plt.clf()
             
-            rvs_ani_star = history.plot_rvs(0, model, data, compare_to_pipeline=True)
-            rvs_ani_star.save(plot_dir+'rvs_star_order{0}.mp4'.format(r), fps=30, extra_args=['-vcodec', 'libx264'])
-            rvs_ani_t = history.plot_rvs(1, model, data)
-            rvs_ani_t.save(plot_dir+'rvs_t_order{0}.mp4'.format(r), fps=30, extra_args=['-vcodec', 'libx264'])
+            history.plot_rvs(0, model, data, compare_to_pipeline=True, filename=plot_dir+'rvs_star_order{0}.mp4'.format(r))
+            history.plot_rvs(1, model, data, filename=plot_dir+'rvs_t_order{0}.mp4'.format(r))
             print('RVs animations saved')
             
-            template_ani_star = history.plot_template(0, model, data, nframes=50)
-            template_ani_star.save(plot_dir+'template_star_order{0}.mp4'.format(r), fps=30, extra_args=['-vcodec', 'libx264'])
-            template_ani_t = history.plot_template(1, model, data, nframes=50)
-            template_ani_t.save(plot_dir+'template_t_order{0}.mp4'.format(r), fps=30, extra_args=['-vcodec', 'libx264'])
+            history.plot_template(0, model, data, nframes=50, filename=plot_dir+'template_star_order{0}.mp4'.format(r))
+            history.plot_template(1, model, data, nframes=50, filename=plot_dir+'template_t_order{0}.mp4'.format(r))
             print('template animations saved')
             
-            chis_ani = history.plot_chis(0, model, data, nframes=50)
-            chis_ani.save(plot_dir+'chis_order{0}_epoch0.mp4'.format(r), fps=30, extra_args=['-vcodec', 'libx264'])
+            history.plot_chis(0, model, data, nframes=50, filename=plot_dir+'chis_order{0}_epoch0.mp4'.format(r))
             print('chis animation saved')
             
             session = wobble.get_session()
@@ -77,7 +72,7 @@ if __name__ == "__main__":
                 plt.savefig(plot_dir+'variable_tellurics_order{0}.png'.format(r))
         print("order {1} optimization finished. time elapsed: {0:.2f} s".format(time() - start_time, r))
     
-    results.compute_final_rvs()
+    results.compute_final_rvs(model)
     if K>0:
         results.write(starname+'_results_variablet.hdf5')
     else: